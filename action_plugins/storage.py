@@ -15,19 +15,30 @@
 
 
 from __future__ import (absolute_import, division, print_function)
+import contextlib
 import importlib
 import json
 import os
 import sqlite3
+import struct
+import time
+import zlib
 
 import six
 
 import ansible
+from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.plugins import action
 try:
     from ansible.utils import sentinel
 except ImportError:
     sentinel = None
+try:
+    import importlib.util as importlib_util
+except ImportError:
+    # Python 2
+    import imp
+    importlib_util = None
 
 
 DEFAULT_PROVIDER = 'cinderlib'
@@ -39,6 +50,30 @@ STORAGE_ATTRIBUTES = 'storage_attributes'
 PROVIDER_CONFIG = 'provider_config'
 BACKEND_CONFIG = 'backend_config'
 CONSUMER_CONFIG = 'consumer_config'
+CONNECTOR_DICT = 'connector_dict'
+# Run DB schema version created by the callback plugin
+SCHEMA_VERSION = 3
+DB_TIMEOUT = 60
+# Run DB blobs header: magic, codec version, codec, and payload length
+BLOB_HEADER = struct.Struct('!4sBBI')
+BLOB_MAGIC = b'STRB'
+BLOB_VERSION = 1
+CODEC_JSON = 0
+CODEC_ZLIB_JSON = 1
+# Smaller payloads don't benefit from compression
+COMPRESS_MIN_SIZE = 256
+# Parameters only used by the controller on batch requests
+BATCH_ARGS = ('volumes', 'max_workers')
+
+
+try:
+    clock = time.monotonic
+except AttributeError:
+    clock = time.time
+
+
+# Role directory, used to import controller modules and their module_utils
+ROLE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 if tuple(map(int, (ansible.__version__.split(".")))) < (2, 7, 0):
@@ -65,34 +100,92 @@ class NotFound(Exception):
         super(NotFound, self).__init__(msg)
 
 
+class Timings(object):
+    """Accumulated duration, in seconds, of the phases of a task.
+
+    Same as module_utils' Timings, that cannot be imported here.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+
+    def add(self, name, duration):
+        if self.enabled:
+            self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add(name, clock() - start)
+
+    def result(self):
+        return {name: round(duration, 6)
+                for name, duration in self.phases.items()}
+
+
 class BackendObj(object):
-    __slots__ = ('id', 'name', 'provider', 'data', 'host', 'attributes',
-                 'ctxt')
-    FIELDS = __slots__
-
-    def __init__(self, decryptor, values):
-        for f, v in zip(self.FIELDS, values):
-            setattr(self, f, v)
-        # We could lazy load these
-        self.attributes = json.loads(self.attributes)
-        self.data = decryptor(self.data)
-
-        self.ctxt = decryptor(self.ctxt)
+    """Backend row from the run DB.
+
+    Fields are decoded the first time they are accessed, and only fields
+    included in the query are available.
+    """
+    FIELDS = ('id', 'name', 'provider', 'data', 'host', 'attributes', 'ctxt')
+    DECODERS = {'attributes': '_decode_attributes',
+                'data': '_decode_data',
+                'ctxt': '_decode_ctxt'}
+    __slots__ = ('_decryptor', '_raw', '_fields')
+
+    def __init__(self, decryptor, values, fields=FIELDS):
+        self._decryptor = decryptor
+        self._raw = dict(zip(fields, values))
+        self._fields = {}
+
+    def __getattr__(self, name):
+        # Only called for fields, as slots are found by regular lookup
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._fields[name]
+        except KeyError:
+            pass
+
+        try:
+            value = self._raw.pop(name)
+        except KeyError:
+            raise AttributeError('Backend field %s has not been loaded' %
+                                 name)
+
+        decoder = self.DECODERS.get(name)
+        if decoder:
+            value = getattr(self, decoder)(value)
+        self._fields[name] = value
+        return value
+
+    def _decode_attributes(self, value):
+        return json.loads(value)
+
+    def _decode_data(self, value):
+        return self._decryptor(value)
+
+    def _decode_ctxt(self, value):
+        ctxt = self._decryptor(value)
         # Reconstruct sets
-        sets = self.ctxt.pop('___sets')
+        sets = ctxt.pop('___sets')
         for key in sets:
-            self.ctxt['_attributes'][key] = set(self.ctxt['_attributes'][key])
-        sets = self.ctxt.pop('___sets_defaults', tuple())
+            ctxt['_attributes'][key] = set(ctxt['_attributes'][key])
+        sets = ctxt.pop('___sets_defaults', tuple())
         for key in sets:
-            self.ctxt['_attr_defaults'][key] = set(
-                self.ctxt['_attr_defaults'][key])
+            ctxt['_attr_defaults'][key] = set(ctxt['_attr_defaults'][key])
         # Reconstruct sentinels
-        sentinels = self.ctxt.pop('___sentinels')
+        sentinels = ctxt.pop('___sentinels')
         for key in sentinels:
-            self.ctxt['_attributes'][key] = sentinel.Sentinel
+            ctxt['_attributes'][key] = sentinel.Sentinel
 
-        if '_become_plugin' in self.ctxt:
-            become_type, become_vars = self.ctxt['_become_plugin']
+        if '_become_plugin' in ctxt:
+            become_type, become_vars = ctxt['_become_plugin']
             path = become_vars['_original_path'].split(os.path.sep)
             # Remove the .py extension
             path[-1] = path[-1].rsplit('.', 1)[0]
@@ -103,7 +196,8 @@ class BackendObj(object):
             plugin = getattr(module, become_type)()
             vars(plugin).clear()
             vars(plugin).update(become_vars)
-            self.ctxt['_become_plugin'] = plugin
+            ctxt['_become_plugin'] = plugin
+        return ctxt
 
 
 class DB(object):
@@ -116,16 +210,22 @@ class DB(object):
                                fail_on_undefined=True, **KWARGS_TEMPLATE)
         inv_path, inv_name = os.path.split(inv)
 
-        self.db = sqlite3.connect(self.task_info['db_name'])
+        db_name = self.task_info['db_name']
+        self.db = sqlite3.connect(db_name, timeout=DB_TIMEOUT)
         self.cursor = self.db.cursor()
+        version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.close()
+            raise ValueError('Run DB %s has schema version %s, expected %s' %
+                             (db_name, version, SCHEMA_VERSION))
 
     def delete_backend(self, backend_id):
         self._delete(id=backend_id)
         self.db.commit()
 
     def providers(self):
-        result = self._query('provider', 'SELECT DISTINCT')
-        return [p[0] for p in result if p[0]]
+        self.cursor.execute('SELECT DISTINCT provider FROM backends')
+        return sorted(p[0] for p in self.cursor.fetchall() if p[0])
 
     @staticmethod
     def _build_filters(filters):
@@ -152,16 +252,17 @@ class DB(object):
         filters_q = self._build_filters(filters)
         query = '%s %s FROM backends%s' % (action, str_fields, filters_q)
         self.cursor.execute(query, filters)
-        results = [BackendObj(self._decrypt, res)
+        results = [BackendObj(self._decrypt, res, fields)
                    for res in self.cursor.fetchall()]
         return results
 
-    def backends(self, provider=None):
-        backends = self._query('*', provider=provider)
-        return backends
+    def backends(self, provider=None, name=None):
+        # Fields are only decoded when used, so filtering in the DB lets a
+        # task decode just the backends it needs.
+        return self._query('*', provider=provider, name=name)
 
     def backend(self, backend=None, provider=None):
-        backends = self._query('*', name=backend, provider=provider)
+        backends = self.backends(provider=provider, name=backend)
         if len(backends) == 0:
             raise NotFound({'backend': backend, 'provider': provider})
         if len(backends) > 1:
@@ -177,8 +278,9 @@ class DB(object):
 
         args = (name, provider, data, host, attributes, ctxt)
 
-        self.cursor.execute('INSERT INTO backends (%s) VALUES (?, ?, ?, ?, '
-                            '?, ?)' % self.BACKEND_FIELDS_STR, args)
+        # Backends are unique per provider, so replace existing ones
+        self.cursor.execute('INSERT OR REPLACE INTO backends (%s) VALUES (?, '
+                            '?, ?, ?, ?, ?)' % self.BACKEND_FIELDS_STR, args)
         self.db.commit()
 
     def save_consumer(self, provider, consumer_config, consumer_module):
@@ -189,26 +291,76 @@ class DB(object):
         self.db.commit()
 
     def get_consumer(self, provider):
-        self.cursor.execute('SELECT consumer_data, consumer_module '
-                            'FROM providers WHERE name=?', (provider,))
+        self.cursor.execute('SELECT consumer_data, consumer_module FROM '
+                            'providers WHERE name=?', (provider,))
         res = self.cursor.fetchone()
         if not res:
             raise NotFound({'provider': provider})
         return json.loads(res[0]), res[1]
 
+    def save_exports(self, provider, backend, exports):
+        """Store connection info of volumes exported to hosts.
+
+        exports is a list of (host, storage_data) tuples.
+        """
+        rows = [(host, provider, backend, data['id'], data.get('name'),
+                 self._encrypt(data)) for host, data in exports]
+        self.cursor.executemany('INSERT OR REPLACE INTO exports (host, '
+                                'provider, backend, volume_id, name, data) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+
+    def get_export(self, host, provider, backend, volume_id=None, name=None):
+        filters = dict(host=host, provider=provider, backend=backend,
+                       volume_id=volume_id, name=name)
+        query = 'SELECT data FROM exports%s' % self._build_filters(filters)
+        self.cursor.execute(query, filters)
+        rows = self.cursor.fetchall()
+        # Ambiguous addressing must go through the controller
+        if len(rows) != 1:
+            return None
+        return self._decrypt(rows[0][0])
+
+    def delete_exports(self, host, provider, backend, volume_id=None,
+                       name=None):
+        filters = dict(host=host, provider=provider, backend=backend,
+                       volume_id=volume_id, name=name)
+        query = 'DELETE FROM exports%s' % self._build_filters(filters)
+        self.cursor.execute(query, filters)
+        self.db.commit()
+
     def _decrypt(self, data):
         # TODO: Decrypt data using self.task_info['secret']
-        try:
-            return json.loads(data)
-        except Exception:
-            return data
+        # Rows stored as JSON text before blobs had a header
+        if isinstance(data, six.text_type) or data is None:
+            try:
+                return json.loads(data)
+            except Exception:
+                return data
+
+        data = bytes(data)
+        magic, version, codec, length = BLOB_HEADER.unpack_from(data)
+        if magic != BLOB_MAGIC or version != BLOB_VERSION:
+            raise ValueError('Unknown run DB blob format')
+
+        payload = data[BLOB_HEADER.size:BLOB_HEADER.size + length]
+        if codec == CODEC_ZLIB_JSON:
+            payload = zlib.decompress(payload)
+        elif codec != CODEC_JSON:
+            raise ValueError('Unknown run DB blob codec %s' % codec)
+        return json.loads(payload.decode('utf-8'))
 
     def _encrypt(self, data):
-        if isinstance(data, dict):
-            data = json.dumps(data)
-
+        payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        codec = CODEC_JSON
+        if len(payload) >= COMPRESS_MIN_SIZE:
+            payload = zlib.compress(payload)
+            codec = CODEC_ZLIB_JSON
+
+        data = BLOB_HEADER.pack(BLOB_MAGIC, BLOB_VERSION, codec,
+                                len(payload)) + payload
         # TODO: Encrypt data using self.task_info['secret']
-        return data
+        return sqlite3.Binary(data)
 
 
 class Resource(object):
@@ -235,19 +387,32 @@ class Resource(object):
                  templar, shared_loader_obj):
         self._templar = templar
         self.action_module = action_module
+        # Phases of this plugin, and of the modules it runs, by node type
+        self.timings = Timings()
+        self.module_timings = {}
         task_info = self._get_var('storage_task_info')
-        self.db = DB(templar, task_info)
+        with self.timings.phase('db'):
+            self.db = DB(templar, task_info)
         self._backend = None
         self._play_context = play_context
 
     @property
     def context(self):
         ctxt = self.backend().ctxt.copy()
-        del ctxt['___fqdn']
-        del ctxt['___machine_id']
+        with self.timings.phase('context'):
+            del ctxt['___fqdn']
+            del ctxt['___machine_id']
+            # Backend is cached, so don't let the play context modify it
+            for key in ('_attributes', '_attr_defaults'):
+                if key in ctxt:
+                    ctxt[key] = ctxt[key].copy()
         return ctxt
 
     def _get_current_context(self, current=None):
+        with self.timings.phase('context'):
+            return self._serialize_context()
+
+    def _serialize_context(self):
         # Make host context JSON compatible
         ctxt = vars(self._play_context).copy()
         sets = []
@@ -299,16 +464,56 @@ class Resource(object):
                 module_args.setdefault('backend', self._backend.name)
                 module_args.setdefault('provider', self._backend.provider)
         else:
-            module_data, module_name = self.db.get_consumer(self.provider_name)
+            with self.timings.phase('db'):
+                module_data, module_name = self.db.get_consumer(
+                    self.provider_name)
         module_args[STORAGE_DATA] = module_data
+        module_args['timings'] = self.timings.enabled
 
         # If this is a controller operation called on consumer pass
-        # controller context
-        if (ctrl and module_args.get('resource') != 'backend' and
+        # controller context.  Backends are created and removed on the node
+        # running the task, which becomes their controller.
+        registering = (module_args.get('resource') == 'backend' and
+                       module_args.get('state', 'present') in ('present',
+                                                               'absent'))
+        if (ctrl and not registering and
                 self.backend().host != self._get_var('ansible_machine_id')):
             kwargs['context'] = self.context
 
-        return self.action_module.runner(module_name, module_args, **kwargs)
+        if ctrl and self._is_local(kwargs.get('context')):
+            kwargs['in_process'] = True
+
+        # Includes transferring and running the module on the node
+        node_type = 'controller' if ctrl else 'consumer'
+        with self.timings.phase(node_type):
+            result = self.action_module.runner(module_name, module_args,
+                                               **kwargs)
+        self._add_module_timings(node_type,
+                                 result.pop('storage_timings', None))
+        # Job lookups must go to the controller that started the job
+        if ctrl and result.get('started') and self._backend:
+            result.setdefault('backend', self._backend.name)
+            result.setdefault('provider', self._backend.provider)
+        return result
+
+    def _add_module_timings(self, node_type, timings):
+        if not timings:
+            return
+        phases = self.module_timings.setdefault(node_type, {})
+        for name, duration in timings.items():
+            phases[name] = round(phases.get(name, 0.0) + duration, 6)
+
+    def _is_local(self, context):
+        """Check if we can run controller modules in this process."""
+        if not self.task_vars.get('storage_in_process', False):
+            return False
+        if context:
+            attributes = context.get('_attributes', context)
+        else:
+            attributes = {'connection': self._play_context.connection,
+                          'become': self._play_context.become}
+        return (attributes.get('connection') == 'local' and
+                not attributes.get('become'))
 
     @property
     def task(self):
@@ -321,7 +526,8 @@ class Resource(object):
         provider = self.task.args.get('provider')
         backend = self.task.args.get('backend')
 
-        backends = self.db._query('*', provider=provider, name=backend)
+        with self.timings.phase('db'):
+            backends = self.db.backends(provider=provider, name=backend)
 
         if not backends:
             raise NotFound({'backend': backend, 'provider': provider})
@@ -351,8 +557,13 @@ class Resource(object):
 
     def execute(self, task_vars):
         self.task_vars = task_vars
-        result = self.run()
-        return result or {}
+        self.timings.enabled = boolean(task_vars.get('storage_timings', True))
+        with self.timings.phase('total'):
+            result = self.run() or {}
+        if self.timings.enabled:
+            result['storage_timings'] = dict(self.module_timings,
+                                             action=self.timings.result())
+        return result
 
     def _get_var(self, name):
         if hasattr(self, 'task_vars') and name in self.task_vars:
@@ -371,7 +582,9 @@ class Resource(object):
             'resource': 'node',
             'ips': ips,
             'multipath': args.get('multipath', True),
-            'enforce_multipath': args.get('enforce_multipath', False)
+            'enforce_multipath': args.get('enforce_multipath', False),
+            # Ignore the properties cached on the node
+            'refresh': args.get('refresh', False),
         }
         return self.runner(pass_args, ctrl=False)
 
@@ -379,7 +592,7 @@ class Resource(object):
         return self.runner(args)
 
     def run(self):
-        state_runner = getattr(self, self.task.args.get('state'),
+        state_runner = getattr(self, self.task.args.get('state') or '',
                                self.default_state_run)
         return state_runner(self.task.args)
 
@@ -390,9 +603,49 @@ class Node(Resource):
 
 
 class Backend(Resource):
-    # stats is handled by Resource.default_state_run
     def stats(self, args):
-        return self.default_state_run(args)
+        if args.get('backend'):
+            return self.default_state_run(args)
+
+        # Stats of all the backends, with one request per controller.
+        # Backends with different provider configs cannot always be set up
+        # in the same process, so they go in separate requests.
+        backends = self.db.backends(provider=args.get('provider'))
+        groups = {}
+        for backend in backends:
+            provider_config = json.dumps(backend.data.get(PROVIDER_CONFIG),
+                                         sort_keys=True)
+            groups.setdefault((backend.provider, backend.host,
+                               provider_config), []).append(backend)
+
+        results = []
+        started = []
+        for (provider, __, __), group in sorted(groups.items()):
+            # Controller context, passed by runner, is taken from the
+            # selected backend
+            self._backend = group[0]
+            pass_args = args.copy()
+            pass_args.update(backend=None, provider=provider,
+                             backends=[{'backend': b.name,
+                                        STORAGE_DATA: b.data}
+                                       for b in group])
+            result = self.runner(pass_args)
+            if result.get('failed', False):
+                # Stats of the other controllers are still returned
+                results.extend({'backend': b.name, 'failed': True,
+                                'msg': result.get('msg')} for b in group)
+            elif result.get('started'):
+                started.append(result)
+            else:
+                results.extend(result['result'])
+
+        result = {'changed': False,
+                  'failed_count': len([r for r in results if r.get('failed')]),
+                  'result': results}
+        if started:
+            # Result only has the controllers that failed to start the job
+            result.update(started=True, jobs=started)
+        return result
 
     def present(self, args):
         consumer_config = self.task.args.pop('consumer_config', {})
@@ -428,7 +681,21 @@ class Backend(Resource):
 
 class Volume(Resource):
     # present and absent states handled by Resource.default_state_run
-    def connected(self, args):
+    def _item_args(self, args, item, storage_data=None):
+        item_args = {k: v for k, v in args.items() if k not in BATCH_ARGS}
+        item_args.update(item)
+        item_args.setdefault('provider', self.provider_name)
+        if storage_data:
+            item_args.update(storage_data)
+        return item_args
+
+    @staticmethod
+    def _batch_result(results):
+        return {'changed': any(r.get('changed') for r in results),
+                'failed_count': len([r for r in results if r.get('failed')]),
+                'results': results}
+
+    def _connector_args(self, args):
         pass_args = args.copy()
         # The connection info must be the connection module name + _info
         conn_info_key = self.db.get_consumer(self.provider_name)[1] + '_info'
@@ -439,26 +706,87 @@ class Volume(Resource):
             result = self._get_brick_info()
 
             if result.get('failed', False):
-                return result
+                return result, None
 
             pass_args.update(result[STORAGE_DATA])
 
         pass_args.setdefault('provider', self.provider_name)
         pass_args['attached_host'] = self._get_var('ansible_fqdn')
+        return None, pass_args
 
-        result = self.runner(pass_args)
+    def _get_attachment(self, args):
+        # Consumer only reports existing attachments without connection info
+        pass_args = args.copy()
+        pass_args.setdefault('provider', self.provider_name)
+        pass_args.setdefault('backend', self.backend().name)
+        return self.runner(pass_args, ctrl=False)
 
-        if result.get('failed', False):
-            return result
+    def _get_export(self, args):
+        # Only use exports when the volume is explicitly addressed
+        if not (args.get('id') or args.get('name')):
+            return None
+        return self.db.get_export(self._get_var('ansible_fqdn'),
+                                  self.provider_name, self.backend().name,
+                                  args.get('id'), args.get('name'))
+
+    def _delete_exports(self, args):
+        self.db.delete_exports(self._get_var('ansible_fqdn'),
+                               self.provider_name, self.backend().name,
+                               args.get('id'), args.get('name'))
 
+    def _connect_on_consumer(self, args, storage_data):
         pass_args = args.copy()
         pass_args.setdefault('provider', self.provider_name)
-        pass_args.update(result[STORAGE_DATA])
+        pass_args.update(storage_data)
+        return self.runner(pass_args, ctrl=False)
 
-        result = self.runner(pass_args, ctrl=False)
-        return result
+    def connected(self, args):
+        if args.get('volumes') is None:
+            # Already connected volumes don't need the controller
+            result = self._get_attachment(args)
+            if result.get('failed', False) or result.get('path'):
+                return result
+
+            # Nor do volumes exported to this node by the exported state
+            storage_data = self._get_export(args)
+            if storage_data:
+                return self._connect_on_consumer(args, storage_data)
+
+        failure, pass_args = self._connector_args(args)
+        if failure:
+            return failure
+
+        result = self.runner(pass_args)
+
+        if result.get('failed', False):
+            return result
+
+        if args.get('volumes') is None:
+            return self._connect_on_consumer(args, result[STORAGE_DATA])
+
+        # Consumer connects all the mapped volumes in a single request
+        results = result['results']
+        mapped = [i for i, r in enumerate(results) if not r.get('failed')]
+        if mapped:
+            pass_args = {k: v for k, v in args.items() if k not in BATCH_ARGS}
+            pass_args.setdefault('provider', self.provider_name)
+            pass_args['volumes'] = [self._item_args({}, results[i]['item'],
+                                                    results[i][STORAGE_DATA])
+                                    for i in mapped]
+            if args.get('max_workers'):
+                pass_args['max_workers'] = args['max_workers']
+            result = self.runner(pass_args, ctrl=False)
+            if result.get('failed', False):
+                return result
+            for i, item_result in zip(mapped, result['results']):
+                item_result['item'] = results[i]['item']
+                results[i] = item_result
+        return self._batch_result(results)
 
     def disconnected(self, args):
+        if args.get('volumes') is not None:
+            return self._batch_disconnected(args)
+
         args = args.copy()
         args.setdefault('provider', self.provider_name)
         result = self.runner(args, ctrl=False)
@@ -468,38 +796,262 @@ class Volume(Resource):
         pass_args = args.copy()
         pass_args['attached_host'] = self._get_var('ansible_fqdn')
         result = self.runner(pass_args)
+        if not result.get('failed', False):
+            self._delete_exports(args)
         return result
 
-    def extended(self, args):
-        # Make the controller request the extend on the backend
-        result = self.runner(args)
+    def _batch_disconnected(self, args):
+        # Detach all the volumes on the consumer in one request first, and
+        # then tell the controller to unmap those that have been detached.
+        pass_args = args.copy()
+        pass_args.setdefault('provider', self.provider_name)
+        result = self.runner(pass_args, ctrl=False)
         if result.get('failed', False):
             return result
 
-        # Make the node notice if it has changed and is attached
-        if result['attached_host']:
+        results = [r for r in result['results'] if r.get('failed')]
+        detached = [r['item'] for r in result['results']
+                    if not r.get('failed')]
+        if detached:
+            result = self._unmap(args, detached)
+            if result.get('failed', False):
+                return result
+            results.extend(result['results'])
+        return self._batch_result(results)
+
+    def _unmap(self, args, volumes):
+        """Unmap volumes detached from this node in a single request."""
+        pass_args = args.copy()
+        pass_args.update(state='disconnected', volumes=volumes,
+                         attached_host=self._get_var('ansible_fqdn'))
+        pass_args.setdefault('provider', self.provider_name)
+        result = self.runner(pass_args)
+        if not result.get('failed', False):
+            for item_result in result['results']:
+                if not item_result.get('failed'):
+                    self._delete_exports(item_result['item'])
+        return result
+
+    def evacuated(self, args):
+        """Disconnect all the volumes attached to the node, or a subset.
+
+        The consumer detaches the volumes of each provider concurrently, and
+        then the controller of each backend unmaps them in a single request.
+        """
+        backends = self.db.backends(provider=args.get('provider'),
+                                    name=args.get('backend'))
+        if not backends:
+            raise NotFound({'backend': args.get('backend'),
+                            'provider': args.get('provider')})
+
+        results = []
+        for provider in sorted(set(b.provider for b in backends)):
+            # Consumer data is taken from the selected backend
+            self._backend = [b for b in backends if b.provider == provider][0]
             pass_args = args.copy()
-            # We cannot pass the size or the node won't find the attachment
-            pass_args.pop('size')
-            pass_args.pop('old_size', None)
-            pass_args['new_size'] = result['new_size']
-            pass_args['provider'] = self.provider_name
-            # pass_args.update(result[STORAGE_DATA])
+            pass_args['provider'] = provider
             result = self.runner(pass_args, ctrl=False)
             if result.get('failed', False):
-                return result
+                results.append({'provider': provider, 'failed': True,
+                                'changed': False, 'msg': result.get('msg')})
+                continue
+
+            detached = {}
+            for item_result in result['results']:
+                if item_result.get('failed'):
+                    results.append(item_result)
+                    continue
+                volume = item_result['item']
+                # The cinderclient controller doesn't look up volumes by the
+                # Cinder id that consumers store, so prefer the name
+                item = ({'name': volume['name']} if volume['name']
+                        else {'id': volume['id']})
+                if volume['host']:
+                    item['host'] = volume['host']
+                detached.setdefault(volume['backend'], []).append(item)
+
+            for backend, volumes in sorted(detached.items()):
+                self._backend = self.db.backend(backend, provider)
+                result = self._unmap(args, volumes)
+                if result.get('failed', False):
+                    # Volumes are detached, but still mapped to the node
+                    results.append({'provider': provider, 'backend': backend,
+                                    'volumes': volumes, 'failed': True,
+                                    'changed': True,
+                                    'msg': result.get('msg')})
+                    continue
+                results.extend(result['results'])
+        return self._batch_result(results)
+
+    def _export_hosts(self, hosts):
+        """Return hosts as dictionaries with their name and connector.
+
+        Hosts can be inventory names, whose connector is taken from the
+        consumer facts gathered by the role, or dictionaries with the host
+        name and its connector.
+        """
+        conn_info_key = self.db.get_consumer(self.provider_name)[1] + '_info'
+        hostvars = self.task_vars.get('hostvars', {})
+        result = []
+        for host in hosts:
+            if isinstance(host, six.string_types):
+                host_vars = hostvars.get(host) or {}
+                conn_info = host_vars.get(conn_info_key) or {}
+                host = {'host': host_vars.get('ansible_fqdn', host),
+                        CONNECTOR_DICT: conn_info.get(CONNECTOR_DICT)}
+            elif isinstance(host, dict):
+                host = {'host': host.get('host'),
+                        CONNECTOR_DICT: host.get(CONNECTOR_DICT)}
+            result.append(host)
+        return result
+
+    def exported(self, args):
+        # The controller maps all the volumes to all the hosts, and consumers
+        # will only need to do the local attach on their connected tasks.
+        pass_args = args.copy()
+        pass_args['hosts'] = self._export_hosts(args.get('hosts') or [])
+        pass_args.setdefault('provider', self.provider_name)
+        result = self.runner(pass_args)
+        if result.get('failed', False):
+            return result
+
+        self.db.save_exports(self.provider_name, self.backend().name,
+                             [(r['attached_host'], r[STORAGE_DATA])
+                              for r in result['results']
+                              if not r.get('failed')])
         return result
 
+    def _extend_on_consumer(self, args, result):
+        pass_args = args.copy()
+        # We cannot pass the size or the node won't find the attachment
+        pass_args.pop('size', None)
+        pass_args.pop('old_size', None)
+        pass_args['new_size'] = result['new_size']
+        pass_args['provider'] = self.provider_name
+        # pass_args.update(result[STORAGE_DATA])
+        return self.runner(pass_args, ctrl=False)
+
+    def extended(self, args):
+        # Make the controller request the extend on the backend
+        result = self.runner(args)
+        if result.get('failed', False):
+            return result
+
+        if args.get('volumes') is None:
+            # Make the node notice if it has changed and is attached
+            if result.get('attached_host'):
+                result = self._extend_on_consumer(args, result)
+            return result
+
+        results = []
+        for item_result in result['results']:
+            if (not item_result.get('failed') and
+                    item_result.get('attached_host')):
+                item = item_result['item']
+                item_result = self._extend_on_consumer(
+                    self._item_args(args, item), item_result)
+                item_result['item'] = item
+            results.append(item_result)
+        return self._batch_result(results)
+
     def run(self):
         original_args = self.task.args.copy()
-        # Automatically set the host parameter
-        self.task.args.setdefault('host', self._get_var('ansible_fqdn'))
+        # Automatically set the host parameter, except to list all volumes or
+        # evacuate all the node's volumes
+        if self.task.args.get('state') not in ('list', 'evacuated'):
+            self.task.args.setdefault('host', self._get_var('ansible_fqdn'))
         try:
             return super(Volume, self).run()
         finally:
             self.task.args = original_args
 
 
+class Job(Resource):
+    def default_state_run(self, args):
+        """Send the jobs to the controllers that started them.
+
+        Jobs passed as task results are routed using the backend in the
+        result, and job ids to the backend selected by the task.
+        """
+        jobs = list(args.get('jobs') or [])
+        if args.get('id'):
+            jobs.append(args['id'])
+
+        groups = {}
+        for job in jobs:
+            key = (None, None)
+            if isinstance(job, dict) and job.get('backend'):
+                key = (job.get('provider'), job['backend'])
+            groups.setdefault(key, []).append(job)
+        if list(groups) in ([], [(None, None)]):
+            return self.runner(args)
+
+        result = {'changed': False}
+        failures = []
+        for (provider, backend), group in groups.items():
+            self._backend = None
+            if backend:
+                self._backend = self.db.backend(backend, provider)
+            pass_args = args.copy()
+            pass_args.pop('id', None)
+            pass_args.update(jobs=group, backend=self.backend().name,
+                             provider=self.backend().provider)
+            group_result = self.runner(pass_args)
+
+            result['changed'] = (result['changed'] or
+                                 group_result.get('changed', False))
+            if 'finished' in group_result:
+                result['finished'] = (result.get('finished', True) and
+                                      group_result['finished'])
+            if 'jobs' in group_result:
+                result.setdefault('jobs', []).extend(group_result['jobs'])
+                result['failed_count'] = (result.get('failed_count', 0) +
+                                          group_result['failed_count'])
+            if group_result.get('failed', False):
+                failures.append({'backend': self.backend().name,
+                                 'provider': self.backend().provider,
+                                 'msg': group_result.get('msg')})
+
+        if failures:
+            result.update(failed=True, failures=failures,
+                          msg='; '.join('%s: %s' % (f['backend'], f['msg'])
+                                        for f in failures))
+        return result
+
+
+_CONTROLLERS = {}
+
+
+def _load_source(name, path):
+    if not importlib_util:
+        return imp.load_source(name, path)
+    spec = importlib_util.spec_from_file_location(name, path)
+    module = importlib_util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_controller(module_name):
+    """Import a controller module to run it in this process.
+
+    Returns None if the module cannot be imported, for example because the
+    provider's libraries are not installed here.
+    """
+    if module_name not in _CONTROLLERS:
+        import ansible.module_utils
+        module_utils = os.path.join(ROLE_PATH, 'module_utils')
+        if module_utils not in ansible.module_utils.__path__:
+            ansible.module_utils.__path__.append(module_utils)
+
+        path = os.path.join(ROLE_PATH, 'library', module_name + '.py')
+        try:
+            _CONTROLLERS[module_name] = _load_source(
+                'storage_' + module_name, path)
+        except Exception:
+            _CONTROLLERS[module_name] = None
+    return _CONTROLLERS[module_name]
+
+
 class ActionModule(action.ActionBase):
     def __init__(self, task, connection, play_context, loader, templar,
                  shared_loader_obj):
@@ -513,8 +1065,14 @@ class ActionModule(action.ActionBase):
         self.resource = Resource.factory(self, task, connection, play_context,
                                          loader, templar, shared_loader_obj)
 
-    def runner(self, module_name, module_args, context=None, **kwargs):
+    def runner(self, module_name, module_args, context=None, in_process=False,
+               **kwargs):
         task_vars = kwargs.pop('task_vars', self.task_vars)
+        if in_process:
+            controller = load_controller(module_name)
+            if controller:
+                return controller.Resource.run_args(module_args)
+
         if context:
             original_ctxt = self._play_context.__dict__
             original_connection = self._connection
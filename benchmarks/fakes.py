@@ -0,0 +1,191 @@
+# Copyright (c) 2018, Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+"""Stand-ins for the storage libraries used by the role's modules.
+
+They only implement what the benchmarks need, so the role's code can be
+imported and driven without cinderlib, os-brick, or cinderclient installed and
+without any storage backend.
+"""
+
+import sys
+import types
+import uuid
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    vars(module).update(attrs)
+    sys.modules[name] = module
+    parent, __, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+class Connection(object):
+    def __init__(self, volume, connector, attached_host):
+        self.volume = volume
+        self.id = str(uuid.uuid4())
+        self.volume_id = volume.id
+        self.attached_host = attached_host
+        self.connection_info = {
+            'conn': {'driver_volume_type': 'iscsi',
+                     'data': {'volume_id': volume.id,
+                              'target_iqn': 'iqn.2018-01.fake:%s' % volume.id,
+                              'target_portal': '192.168.1.1:3260',
+                              'target_lun': 0}},
+            'connector': connector}
+
+    def disconnect(self):
+        self.volume.connections.remove(self)
+
+
+class Volume(object):
+    def __init__(self, backend, size, name=None, id=None, host=None,
+                 cluster_name=None):
+        self.backend = backend
+        self.id = id or str(uuid.uuid4())
+        self.name = name
+        self.size = size
+        self.host = host
+        self.cluster_name = cluster_name
+        self.connections = []
+
+    def connect(self, connector_dict, attached_host=None):
+        connection = Connection(self, connector_dict, attached_host)
+        self.connections.append(connection)
+        return connection
+
+    def delete(self):
+        self.backend.volumes.remove(self)
+        del self.backend.volumes_by_id[self.id]
+
+
+class Persistence(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_volumes(self, volume_id=None, volume_name=None,
+                    backend_name=None):
+        # Like the DB, looking up by primary key doesn't go through all rows
+        if volume_id:
+            vol = self.backend.volumes_by_id.get(volume_id)
+            return [vol] if vol and (not volume_name or
+                                     vol.name == volume_name) else []
+        return [v for v in self.backend.volumes
+                if (not volume_id or v.id == volume_id) and
+                (not volume_name or v.name == volume_name)]
+
+    def get_connections(self, connection_id=None, volume_id=None):
+        return [c for v in self.backend.volumes for c in v.connections
+                if (not volume_id or v.id == volume_id) and
+                (not connection_id or c.id == connection_id)]
+
+
+class Backend(object):
+    """cinderlib Backend with volumes kept in memory."""
+    global_initialization = False
+
+    @classmethod
+    def global_setup(cls, **kwargs):
+        # Like cinderlib, it can only be set up once per process
+        if cls.global_initialization:
+            raise Exception('Already setup')
+        cls.global_initialization = True
+
+    def __init__(self, volume_backend_name='fake', **kwargs):
+        self.id = volume_backend_name
+        self.pool_names = ['fake_pool']
+        self.volumes = []
+        self.volumes_by_id = {}
+        self.persistence = Persistence(self)
+
+    def create_volume(self, size, name=None, id=None, host=None,
+                      cluster_name=None):
+        vol = Volume(self, size, name, id, host, cluster_name)
+        self.volumes.append(vol)
+        self.volumes_by_id[vol.id] = vol
+        return vol
+
+    def stats(self, refresh=False):
+        return {'volume_backend_name': self.id,
+                'pools': [{'pool_name': name, 'free_capacity_gb': 100,
+                           'total_capacity_gb': 200}
+                          for name in self.pool_names]}
+
+
+class Connector(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @staticmethod
+    def factory(protocol, *args, **kwargs):
+        return Connector()
+
+    def connect_volume(self, connection_properties):
+        return {'path': '/dev/sdb', 'type': 'block'}
+
+    def disconnect_volume(self, *args, **kwargs):
+        pass
+
+    def extend_volume(self, connection_properties):
+        return 2 * 1024 ** 3
+
+    def check_valid_device(self, path, *args, **kwargs):
+        return True
+
+
+class BrickException(Exception):
+    pass
+
+
+class ProcessExecutionError(Exception):
+    pass
+
+
+def install():
+    """Register the stand-ins as the real libraries."""
+    _module('cinderlib', setup=Backend.global_setup, Backend=Backend)
+
+    _module('os_brick')
+    _module('os_brick.exception', BrickException=BrickException)
+    _module('os_brick.initiator')
+    _module('os_brick.initiator.connector',
+            InitiatorConnector=Connector,
+            get_connector_properties=lambda *args, **kwargs: {
+                'platform': 'x86_64', 'os_type': 'linux', 'ip': '10.0.0.1',
+                'host': 'consumer', 'multipath': False,
+                'initiator': 'iqn.1994-05.com.redhat:fake'})
+    _module('os_brick.initiator.connectors')
+    _module('os_brick.initiator.connectors.rbd', RBDConnector=Connector)
+    _module('os_brick.privileged')
+    _module('os_brick.privileged.rootwrap')
+
+    _module('oslo_concurrency')
+    _module('oslo_concurrency.processutils',
+            ProcessExecutionError=ProcessExecutionError,
+            execute=lambda *args, **kwargs: ('', ''))
+    _module('oslo_utils')
+    _module('oslo_utils.fileutils',
+            delete_if_exists=lambda path: None)
+    _module('oslo_utils.strutils',
+            mask_password=lambda value: value)
+
+    _module('cinderclient')
+    _module('cinderclient.client', Client=lambda *args, **kwargs: None)
+    _module('cinderclient.exceptions', NotFound=Exception)
+    _module('keystoneauth1')
+    _module('keystoneauth1.loading')
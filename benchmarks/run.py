@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+"""Micro-benchmarks for the role's hot paths.
+
+Drives the action plugin's run DB, the modules' plumbing, and the consumer's
+attachments DB with stand-ins for the storage libraries, so only Ansible is
+required.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --save-baseline
+    python benchmarks/run.py --baseline benchmarks/baseline.json
+
+Results are stored as JSON, and when there's a baseline each benchmark is
+compared against it using the median time per call.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import importlib.util as importlib_util
+except ImportError:
+    # Python 2
+    import imp
+    importlib_util = None
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+ROLE_PATH = os.path.dirname(BENCH_PATH)
+DEFAULT_BASELINE = os.path.join(BENCH_PATH, 'baseline.json')
+
+sys.path.insert(0, BENCH_PATH)
+import fakes  # noqa
+
+fakes.install()
+
+import ansible.module_utils  # noqa
+from ansible.module_utils import basic  # noqa
+
+# Same as the action plugin does to load controller modules in process
+ansible.module_utils.__path__.append(os.path.join(ROLE_PATH, 'module_utils'))
+
+from ansible.module_utils.storage import base  # noqa
+from ansible.module_utils.storage import common  # noqa
+
+BENCHMARKS = []
+
+
+def benchmark(size):
+    """Register a benchmark function that is passed the scaled size.
+
+    The function must return the callable to time.
+    """
+    def decorator(func):
+        BENCHMARKS.append((func.__name__, size, func))
+        return func
+    return decorator
+
+
+def _load(name, *path):
+    path = os.path.join(ROLE_PATH, *path)
+    if not importlib_util:
+        return imp.load_source(name, path)
+    spec = importlib_util.spec_from_file_location(name, path)
+    module = importlib_util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeTemplar(object):
+    def template(self, name, **kwargs):
+        return os.path.join(TMP_DIR, 'inventory')
+
+
+class FakeLoader(object):
+    def get_basedir(self):
+        return TMP_DIR
+
+
+class FakePlaybook(object):
+    def get_loader(self):
+        return FakeLoader()
+
+
+class FakePlayContext(object):
+    def __init__(self, size):
+        self._attributes = {'attr_%s' % i: 'value_%s' % i
+                            for i in range(size)}
+        self._attributes.update(connection='ssh', become=False,
+                                remote_addr='10.0.0.1', port=22,
+                                remote_user='root',
+                                only_tags={'all'}, skip_tags=set())
+        self._attr_defaults = {'only_tags': {'all'}, 'skip_tags': set()}
+
+
+class FakeModule(object):
+    def __init__(self, params):
+        self.params = params
+
+    def fail_json(self, **kwargs):
+        raise Exception(kwargs['msg'])
+
+
+def _storage_data(i):
+    return {common.PROVIDER_CONFIG: {'locks_path': os.path.join(TMP_DIR,
+                                                                'locks'),
+                                     'disable_logs': True,
+                                     'persistence_config': {
+                                         'storage': 'db',
+                                         'connection': 'sqlite:///db'}},
+            common.BACKEND_CONFIG: {'volume_backend_name': 'backend%s' % i,
+                                    'volume_driver': 'fake.Driver',
+                                    'san_ip': '192.168.1.%s' % (i % 255),
+                                    'san_login': 'admin',
+                                    'san_password': 'password'},
+            common.SERVICE_SOCKET: ''}
+
+
+def _new_run_db(callback, action_plugin, backends):
+    callback.v2_playbook_on_start(FakePlaybook())
+    task_info = {'db_name': callback.db_name, 'secret': callback.secret}
+    db = action_plugin.DB(FakeTemplar(), task_info)
+    ctxt = {'_attributes': FakePlayContext(20)._attributes,
+            '___sets': [], '___sentinels': [], '___fqdn': 'controller',
+            '___machine_id': 'machine-id'}
+    ctxt['_attributes'] = {k: list(v) if isinstance(v, set) else v
+                           for k, v in ctxt['_attributes'].items()}
+    for i in range(backends):
+        db.create_backend('backend%s' % i,
+                          'cinderlib' if i % 2 else 'cinderclient',
+                          _storage_data(i), 'machine-id',
+                          {'type': common.BLOCK,
+                           'consumer': 'cinderlib_storage_consumer'},
+                          ctxt)
+    return db
+
+
+@benchmark(2000)
+def run_db_query(size):
+    db = _new_run_db(CALLBACK.CallbackModule(), ACTION, size)
+
+    def run():
+        for backend in db._query('*'):
+            backend.data, backend.attributes, backend.ctxt
+    return run
+
+
+@benchmark(2000)
+def run_db_backend_lookup(size):
+    db = _new_run_db(CALLBACK.CallbackModule(), ACTION, size)
+    names = ['backend%s' % random.randrange(size) for __ in range(100)]
+
+    def run():
+        # Each task runs in a new worker process with its own DB object
+        for name in names:
+            task_db = ACTION.DB(FakeTemplar(), db.task_info)
+            task_db.backends(name=name)[0].data
+            task_db.db.close()
+    return run
+
+
+@benchmark(200)
+def current_context(size):
+    resource = object.__new__(ACTION.Volume)
+    resource.task_vars = {'ansible_fqdn': 'consumer',
+                          'ansible_machine_id': 'machine-id'}
+    resource.timings = ACTION.Timings(enabled=False)
+
+    def run():
+        # Serialization modifies the play context
+        resource._play_context = FakePlayContext(size)
+        json.dumps(resource._get_current_context())
+    return run
+
+
+@benchmark(1000)
+def pop_param(size):
+    args = {'ANSIBLE_MODULE_ARGS': {
+        'resource': 'volume', 'state': 'connected',
+        common.STORAGE_DATA: _storage_data(0),
+        'volumes': [{'name': 'vol%s' % i, 'size': 1} for i in range(size)]}}
+    encoded = json.dumps(args).encode('utf-8')
+
+    def run():
+        basic._ANSIBLE_ARGS = encoded
+        base.Resource._pop_param(common.STORAGE_DATA)
+    return run
+
+
+@benchmark(1000)
+def set_encoder(size):
+    now = datetime.datetime.now()
+    result = {'changed': True,
+              'results': [{'id': str(i), 'name': 'vol%s' % i, 'size': 1,
+                           'created_at': now, 'tags': {'a', 'b', 'c'},
+                           common.STORAGE_DATA: _storage_data(i)}
+                          for i in range(size)]}
+
+    def run():
+        json.dumps(result, cls=base._SetEncoder)
+    return run
+
+
+def _attachment(i):
+    return {'id': 'vol-%s' % i, 'name': 'vol%s' % i, 'provider': 'cinderlib',
+            'backend': 'backend%s' % (i % 10), 'host': 'consumer@b#p',
+            'size': 1}
+
+
+def _consumer_db(size):
+    params = {common.STORAGE_DATA: {common.CONSUMER_CONFIG: {
+        'db_file': tempfile.mktemp(dir=TMP_DIR)}}}
+    db = CONSUMER._setup_db(params)
+    return db
+
+
+@benchmark(1000)
+def consumer_save_attachment(size):
+    attachments = [_attachment(i) for i in range(size)]
+    data = {'device': {'path': '/dev/sdb', 'type': 'block'},
+            common.CONNECTION_INFO: {'conn': {'data': {}}}, 'connector': {}}
+
+    def run():
+        db = _consumer_db(size)
+        for params in attachments:
+            CONSUMER._save_attachment(db, params, data)
+        db.close()
+    return run
+
+
+@benchmark(2000)
+def consumer_get_attachment(size):
+    db = _consumer_db(size)
+    data = {'device': {'path': '/dev/sdb', 'type': 'block'}}
+    for i in range(size):
+        CONSUMER._save_attachment(db, _attachment(i), data)
+    modules = [FakeModule({'id': 'vol-%s' % random.randrange(size),
+                           'name': None, 'provider': 'cinderlib',
+                           'backend': None, 'size': None, 'host': None})
+               for __ in range(100)]
+
+    def run():
+        for module in modules:
+            CONSUMER._get_data(db, module)
+    return run
+
+
+@benchmark(2000)
+def controller_get_volume(size):
+    storage_data = _storage_data(0)
+    resource = CONTROLLER.Volume(None, storage_data)
+    backend = resource.backend
+    del backend.volumes[:]
+    backend.volumes_by_id.clear()
+    for i in range(size):
+        params = resource._prepare_params({'host': 'consumer%s' % i})
+        backend.create_volume(1, 'vol%s' % i, host=params['host'],
+                              cluster_name=params['cluster_name'])
+    lookups = [resource._prepare_params({'id': None, 'name': None,
+                                         'size': None,
+                                         'host': 'consumer%s' %
+                                         random.randrange(size)})
+               for __ in range(20)]
+
+    def run():
+        for params in lookups:
+            resource._get_volume(params)
+    return run
+
+
+@benchmark(200)
+def controller_setup_backends(size):
+    # Backends initialized by a controller service or a stats request
+    storage_data = [_storage_data(i) for i in range(size)]
+
+    def run():
+        CONTROLLER.BACKENDS.clear()
+        for data in storage_data:
+            CONTROLLER.Backend(None, data)
+    return run
+
+
+def _time(func, rounds, min_time):
+    """Return the time per call of each round in seconds."""
+    # Calibrate the number of calls so a round lasts at least min_time
+    number = 1
+    while True:
+        start = time.time()
+        for __ in range(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time or number >= 1000:
+            break
+        number *= 2
+
+    timings = []
+    for __ in range(rounds):
+        start = time.time()
+        for __ in range(number):
+            func()
+        timings.append((time.time() - start) / number)
+    return timings, number
+
+
+def _stats(timings):
+    timings = sorted(timings)
+    middle = len(timings) // 2
+    if len(timings) % 2:
+        median = timings[middle]
+    else:
+        median = (timings[middle - 1] + timings[middle]) / 2.0
+    return {'min': timings[0], 'max': timings[-1], 'median': median,
+            'mean': sum(timings) / len(timings)}
+
+
+def compare(results, baseline, threshold):
+    comparison = {}
+    for name, result in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if not old or old['size'] != result['size']:
+            comparison[name] = {'status': 'new'}
+            continue
+
+        ratio = result['median'] / old['median']
+        if ratio > 1 + threshold:
+            status = 'slower'
+        elif ratio < 1 - threshold:
+            status = 'faster'
+        else:
+            status = 'same'
+        comparison[name] = {'status': status, 'ratio': ratio,
+                            'baseline_median': old['median']}
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='File to store the results in')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='Results to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as the new baseline')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplier for the size of the benchmarks')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Minimum duration of a round in seconds')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change considered a difference')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Names of the benchmarks to run, default all')
+    args = parser.parse_args()
+
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'date': datetime.datetime.utcnow().isoformat(),
+               'scale': args.scale,
+               'benchmarks': {}}
+
+    for name, size, func in BENCHMARKS:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        size = max(1, int(size * args.scale))
+        timings, number = _time(func(size), args.rounds, args.min_time)
+        result = _stats(timings)
+        result.update(size=size, rounds=args.rounds, number=number)
+        results['benchmarks'][name] = result
+        print('%-28s size=%-6s median=%.6fs min=%.6fs' %
+              (name, size, result['median'], result['min']))
+
+    regressions = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        results['comparison'] = compare(results, baseline, args.threshold)
+        print('\nComparison with %s:' % args.baseline)
+        for name, comparison in sorted(results['comparison'].items()):
+            if comparison['status'] == 'new':
+                print('%-28s new' % name)
+                continue
+            print('%-28s %-6s x%.2f' % (name, comparison['status'],
+                                        comparison['ratio']))
+            if comparison['status'] == 'slower':
+                regressions.append(name)
+
+    output = args.baseline if args.save_baseline else args.output
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+
+TMP_DIR = tempfile.mkdtemp(prefix='storage-bench-')
+ACTION = _load('storage_action', 'action_plugins', 'storage.py')
+CALLBACK = _load('storage_callback', 'callback_plugins', 'storage.py')
+CONSUMER = _load('cinderlib_storage_consumer', 'library',
+                 'cinderlib_storage_consumer.py')
+CONTROLLER = _load('cinderlib_storage_controller', 'library',
+                   'cinderlib_storage_controller.py')
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    finally:
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
@@ -21,6 +21,11 @@ import uuid
 from ansible.plugins.callback import CallbackBase
 
 __metaclass__ = type
+
+# Must match the action plugin's
+SCHEMA_VERSION = 3
+DB_TIMEOUT = 60
+
 DOCUMENTATION = '''
     callback: storage
     type: aggregate
@@ -47,24 +52,38 @@ class CallbackModule(CallbackBase):
         self.db_name = os.path.join(basedir,
                                     '.storage-%s.sqlite' % self.run_id)
 
-        self.db = sqlite3.connect(self.db_name)
+        self.db = sqlite3.connect(self.db_name, timeout=DB_TIMEOUT)
         self.cursor = self.db.cursor()
 
+        # Readers don't block writers, and writers wait for each other
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute('PRAGMA synchronous=NORMAL')
         self.cursor.execute('CREATE TABLE IF NOT EXISTS backends (id INTEGER '
-                            'PRIMARY KEY, name TEXT, provider TEXT, data '
-                            'TEXT, host TEXT, attributes TEXT, ctxt TEXT)')
+                            'PRIMARY KEY, name TEXT NOT NULL, provider TEXT '
+                            'NOT NULL, data TEXT, host TEXT, attributes '
+                            'TEXT, ctxt TEXT, UNIQUE (name, provider))')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS backends_provider ON '
+                            'backends (provider)')
         self.cursor.execute('CREATE TABLE IF NOT EXISTS providers (name TEXT '
                             'PRIMARY KEY, consumer_data TEXT, '
                             'consumer_module TEXT)')
+        # Connection info of volumes exported by the controller to consumers
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS exports (id INTEGER '
+                            'PRIMARY KEY, host TEXT NOT NULL, provider TEXT '
+                            'NOT NULL, backend TEXT NOT NULL, volume_id TEXT '
+                            'NOT NULL, name TEXT, data BLOB, UNIQUE (host, '
+                            'provider, backend, volume_id))')
+        self.cursor.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
         self.db.commit()
         self.cursor.close()
         self.db.close()
 
     def v2_playbook_on_stats(self, stats):
-        try:
-            os.remove(self.db_name)
-        except OSError:
-            pass
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.db_name + suffix)
+            except OSError:
+                pass
 
     def v2_playbook_on_play_start(self, play):
         play.vars['storage_task_info'] = {'run_id': self.run_id,
@@ -16,30 +16,140 @@
 #    under the License.
 #
 
+import hashlib
+import json
 import os
+import random
+import threading
 import time
 import uuid
 
 # from ansible.module_utils.
 # from ansible.module_utils import basic
 
+from cinderclient import api_versions
 from cinderclient import client as cinder
 from cinderclient import exceptions
 from keystoneauth1 import loading
+import requests
 
 from ansible.module_utils.storage import base
 from ansible.module_utils.storage import common
+from ansible.module_utils.storage import utils
 
 
 HOME = os.path.expanduser("~")
 
-REFRESH_TIME = 1
+# Volume status polling uses exponential backoff with jitter
+POLL_INITIAL_INTERVAL = 0.5
+POLL_MAX_INTERVAL = 10
+POLL_JITTER = 0.2
+POLL_TIMEOUT = 600
+# Polling fewer volumes requests them one by one instead of listing them
+POLL_GET_MAX = 10
+# Volumes requested to Cinder at a time when listing them
+LIST_PAGE_SIZE = 100
+# Keystone tokens, volume types, and supported filters are cached across
+# module invocations
+AUTH_CACHE_PATH = os.path.join(HOME, '.storage_cinderclient')
+CACHE_TIME = 300
+# Use the highest microversion supported by Cinder and cinderclient
+AUTO_VERSION = 'auto'
+# Microversions with the features used to reduce the size of responses
+RESOURCE_FILTERS_VERSION = '3.33'
+POOLS_VOLUME_TYPE_FILTER_VERSION = '3.35'
+# HTTP connections kept to each endpoint, shared by the threads of batches
+HTTP_POOL_SIZE = 32
+
+# Sessions created in this process, by credentials
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+class AuthCache(object):
+    """Cache of a user's keystone token, service catalog, and volume types.
+
+    It's stored on the controller and keyed by a hash of the credentials, so
+    changing them invalidates the cache and they are not written anywhere.
+    Cached tokens are only used until they expire, keystoneauth takes care of
+    requesting a new one.
+    """
+    def __init__(self, auth_cfg, path=AUTH_CACHE_PATH):
+        data = json.dumps(auth_cfg, sort_keys=True)
+        self.key = hashlib.sha256(data.encode('utf-8')).hexdigest()
+        self.path = path
+        self.filename = os.path.join(path, self.key + '.json')
+        self.lock = threading.Lock()
+        self.data = utils.read_json(self.filename) or {}
+
+    def _update(self, **kwargs):
+        with self.lock:
+            self.data.update(kwargs)
+            utils.makedirs(self.path)
+            # Tokens are credentials
+            os.chmod(self.path, 0o700)
+            utils.write_json(self.filename, self.data)
+
+    def load_auth(self, plugin):
+        auth_state = self.data.get('auth_state')
+        if auth_state:
+            plugin.set_auth_state(auth_state)
+
+    def save_auth(self, plugin):
+        auth_state = plugin.get_auth_state()
+        if auth_state != self.data.get('auth_state'):
+            self._update(auth_state=auth_state)
+
+    def get(self, section, key):
+        """Return a cached value or None if it's missing or too old."""
+        entry = self.data.get(section, {}).get(key)
+        if entry and time.time() - entry.get('cached_at', 0) < CACHE_TIME:
+            return entry.get('value')
+        return None
+
+    def set(self, section, key, value):
+        entries = self.data.get(section, {}).copy()
+        entries[key] = {'value': value, 'cached_at': time.time()}
+        self._update(**{section: entries})
+        return value
+
+
+def _get_session(auth_system, auth_cfg):
+    """Return the cache, auth plugin, and keystone session for credentials.
+
+    Sessions are shared by all the clients of this process using the same
+    credentials, so their HTTP connections are reused.
+    """
+    cache = AuthCache(dict(auth_cfg, auth_system=auth_system))
+    with _SESSIONS_LOCK:
+        if cache.key not in _SESSIONS:
+            loader = loading.base.get_plugin_loader(auth_system)
+            plugin = loader.load_from_options(**auth_cfg)
+            cache.load_auth(plugin)
+
+            http = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            http.mount('https://', adapter)
+            http.mount('http://', adapter)
+            auth_session = loading.session.Session().load_from_options(
+                auth=plugin, session=http)
+
+            # Only goes to keystone if there's no valid cached token
+            auth_session.get_token()
+            cache.save_auth(plugin)
+            _SESSIONS[cache.key] = (cache, plugin, auth_session)
+        return _SESSIONS[cache.key]
 
 
 class Resource(base.Resource):
+    RESOURCES = {}
+
     def __init__(self, *args, **kwargs):
         super(Resource, self).__init__(*args, **kwargs)
-        self.backend = self._setup(self.storage_data)
+        self.backend = None
+        if self.NEEDS_BACKEND:
+            self.backend = self._setup(self.storage_data)
 
     def _setup(self, storage_data):
         if not storage_data:
@@ -50,17 +160,139 @@ class Resource(base.Resource):
         self.volume_backend_name = params.pop('volume_backend_name', None)
         self.volume_type = params.pop('volume_type', None)
 
-        loader = loading.base.get_plugin_loader(params.pop('auth_system'))
+        auth_system = params.pop('auth_system')
         auth_cfg = {k: params.pop(k)
                     for k in ('auth_url', 'username', 'password',
                               'project_name', 'user_domain_id',
                               'project_domain_id')}
-        plugin = loader.load_from_options(**auth_cfg)
-        auth_session = loading.session.Session().load_from_options(auth=plugin)
+        self.auth_cache, plugin, auth_session = _get_session(auth_system,
+                                                             auth_cfg)
+        self.region_name = params['region_name']
         params.update(auth_plugin=plugin, session=auth_session)
+        if params['version'] == AUTO_VERSION:
+            params['version'] = self._negotiate_version(params)
         client = cinder.Client(**params)
         return client
 
+    def _negotiate_version(self, params):
+        """Return the highest microversion supported by Cinder and us."""
+        version = self.auth_cache.get('api_version', self.region_name)
+        if version is None:
+            client = cinder.Client(**dict(params, version='3.0'))
+            version = api_versions.discover_version(
+                client, api_versions.APIVersion('3.latest')).get_string()
+            self.auth_cache.set('api_version', self.region_name, version)
+        return version
+
+    def _supports(self, version):
+        api_version = getattr(self.backend, 'api_version', None)
+        return (bool(api_version) and
+                api_version >= api_versions.APIVersion(version))
+
+    def _resource_filters(self, resource):
+        """Return the filters Cinder accepts for a resource.
+
+        Returns None when Cinder doesn't tell us.
+        """
+        if not self._supports(RESOURCE_FILTERS_VERSION):
+            return None
+
+        key = '%s:%s' % (self.region_name, resource)
+        filters = self.auth_cache.get('resource_filters', key)
+        if filters is None:
+            filters = [f for rf in self.backend.resource_filters.list(
+                resource=resource) for f in rf.filters]
+            self.auth_cache.set('resource_filters', key, filters)
+        return filters
+
+
+class StatusPoller(object):
+    """Refresh volumes for many threads with a single request.
+
+    Threads waiting for volumes on a batch request ask for them to be
+    refreshed, and one of them requests all the pending volumes together
+    while the others wait for its results.  Volumes are listed when that
+    takes fewer requests than getting them one by one.
+    """
+    def __init__(self, client, search_opts):
+        self.client = client
+        self.search_opts = search_opts
+        self.cond = threading.Condition()
+        self.pending = set()
+        self.results = {}
+        self.started = 0
+        self.completed = 0
+        self.polling = False
+        # Requests the last list of volumes took
+        self.list_requests = 0
+
+    def _get(self, volume_id):
+        try:
+            return self.client.volumes.get(volume_id)
+        except exceptions.NotFound:
+            return None
+
+    def _poll(self, ids):
+        # Listing the volumes takes a request per page, so with large backends
+        # getting a few volumes one by one is cheaper.
+        if len(ids) <= max(POLL_GET_MAX, self.list_requests):
+            return {volume_id: self._get(volume_id) for volume_id in ids}
+
+        # Go through the backend's volumes sorted by id, and stop once we
+        # have gone past the last volume we are polling.
+        results = {}
+        last_id = max(ids)
+        marker = None
+        requests = 0
+        while True:
+            vs = self.client.volumes.list(detailed=True,
+                                          search_opts=self.search_opts,
+                                          marker=marker, limit=LIST_PAGE_SIZE,
+                                          sort='id:asc')
+            requests += 1
+            results.update((v.id, v) for v in vs if v.id in ids)
+            if (len(results) == len(ids) or len(vs) < LIST_PAGE_SIZE or
+                    vs[-1].id >= last_id):
+                break
+            marker = vs[-1].id
+        self.list_requests = requests
+
+        # Deleted volumes
+        for volume_id in ids.difference(results):
+            results[volume_id] = self._get(volume_id)
+        return results
+
+    def refresh(self, volume_id):
+        """Return the refreshed volume, or None if it no longer exists."""
+        with self.cond:
+            self.pending.add(volume_id)
+            # A poll already running may not include our volume
+            target = self.started + 1
+            while self.completed < target:
+                if self.polling:
+                    self.cond.wait()
+                    continue
+
+                self.polling = True
+                self.started += 1
+                ids, self.pending = self.pending, set()
+                self.cond.release()
+                try:
+                    results = self._poll(ids)
+                except Exception as exc:
+                    results = dict.fromkeys(ids, exc)
+                finally:
+                    self.cond.acquire()
+                    self.polling = False
+                self.results.update(results)
+                self.completed = self.started
+                self.cond.notify_all()
+
+            result = self.results[volume_id]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
 
 @Resource.register
 class Backend(Resource, base.Backend):
@@ -74,7 +306,7 @@ class Backend(Resource, base.Backend):
         'project_domain_id': {'type': 'str', 'default': 'default'},
         'region_name': {'type': 'str', 'required': True},
         'username': {'type': 'str', 'required': True},
-        'version': {'type': 'str', 'default': '3.27'},
+        'version': {'type': 'str', 'default': AUTO_VERSION},
         'volume_type': {'type': 'str'},
     }
 
@@ -85,15 +317,10 @@ class Backend(Resource, base.Backend):
                     'msg': 'missing required argument: backend'}
 
         self.backend = self._setup(params)
-
-        if self.volume_type:
-            vol_type = self.backend.volume_types.find(name=self.volume_type)
-        else:
-            vol_type = self.backend.volume_types.default()
-
-        backend_name = vol_type.extra_specs.get('volume_backend_name')
-        params[common.BACKEND_CONFIG]['volume_backend_name'] = backend_name
-        params[common.BACKEND_CONFIG]['volume_type'] = vol_type.name
+        vol_type = self._get_volume_type()
+        params[common.BACKEND_CONFIG]['volume_backend_name'] = (
+            vol_type['backend_name'])
+        params[common.BACKEND_CONFIG]['volume_type'] = vol_type['name']
 
         result = {
             common.STORAGE_DATA: params,
@@ -104,20 +331,40 @@ class Backend(Resource, base.Backend):
         }
         return result
 
-    @Resource.state
-    def stats(self, params):
-        stats = self.backend.pools.list(detailed=True)
+    def _get_volume_type(self):
+        key = '%s:%s' % (self.region_name, self.volume_type or '')
+        vol_type = self.auth_cache.get('volume_types', key)
+        if vol_type:
+            return vol_type
+
+        if self.volume_type:
+            vol_type = self.backend.volume_types.find(name=self.volume_type)
+        else:
+            vol_type = self.backend.volume_types.default()
+        return self.auth_cache.set('volume_types', key, {
+            'name': vol_type.name,
+            'backend_name': vol_type.extra_specs.get('volume_backend_name')})
+
+    def _get_stats(self):
+        # Let Cinder filter the pools when it can
+        if (self.volume_type and
+                self._supports(POOLS_VOLUME_TYPE_FILTER_VERSION)):
+            stats = self.backend.pools.list(
+                detailed=True, search_opts={'volume_type': self.volume_type})
+        else:
+            stats = self.backend.pools.list(detailed=True)
 
         if self.volume_backend_name:
             stats = [p for p in stats
                      if p.volume_backend_name == self.volume_backend_name]
 
+        # Stats are cached, so they must be JSON serializable
+        stats = [p.to_dict()['capabilities'] for p in stats]
         if not stats:
             stats = {}
         elif len(stats) == 1:
-            stats = stats[0].to_dict()['capabilities']
-
-        return {'changed': False, 'result': stats}
+            stats = stats[0]
+        return stats
 
     @Resource.state
     def absent(self, params):
@@ -128,6 +375,12 @@ class Backend(Resource, base.Backend):
 class Volume(Resource, base.Volume):
     METADATA_FIELDS = ('id', 'host', 'backend')
 
+    def __init__(self, *args, **kwargs):
+        super(Volume, self).__init__(*args, **kwargs)
+        # Shared by the threads of batch requests
+        self._status_poller = None
+        self._poller_lock = threading.Lock()
+
     @classmethod
     def _to_json(cls, vol):
         res = {'id': vol.id, 'name': vol.name, 'size': vol.size, 'type': 'volume'}
@@ -152,13 +405,44 @@ class Volume(Resource, base.Volume):
             metadata['host'] = params['host']
         return cparams
 
+    def _search_opts(self, params):
+        """Return Cinder's search options for the params.
+
+        Size and volume type are only included when Cinder supports filtering
+        by them, and the second returned value tells if all the params were
+        included.
+        """
+        search_opts = self._build_cinderclient_params(params)
+        filters = self._resource_filters('volume') or ()
+        complete = True
+        for key, value in (('size', params.get('size')),
+                           ('volume_type', self.volume_type)):
+            if value is None:
+                continue
+            if key in filters:
+                search_opts[key] = value
+            else:
+                complete = False
+        return search_opts, complete
+
     def _get_volume(self, params, fail_not_found=False):
         clean_params = {k: v for k, v in params.items() if v is not None}
-        search_opts = self._build_cinderclient_params(clean_params)
-        vs = self.backend.volumes.list(detailed=True, search_opts=search_opts)
-
-        # We cannot filter Cinder's list by size or type, so we do it here
-        filtered_vs = [v for v in vs if self._matches(v, clean_params)]
+        search_opts, complete = self._search_opts(clean_params)
+
+        # We only need to know if there are more than one volume, and when
+        # Cinder cannot filter by size or type we do it here page by page.
+        limit = 2 if complete else LIST_PAGE_SIZE
+        filtered_vs = []
+        marker = None
+        while len(filtered_vs) < 2:
+            vs = self.backend.volumes.list(detailed=True,
+                                           search_opts=search_opts,
+                                           marker=marker, limit=limit,
+                                           sort='id:asc')
+            filtered_vs.extend(v for v in vs if self._matches(v, clean_params))
+            if complete or len(vs) < limit:
+                break
+            marker = vs[-1].id
 
         if not filtered_vs:
             if fail_not_found:
@@ -170,7 +454,47 @@ class Volume(Resource, base.Volume):
 
         return filtered_vs[0]
 
+    def _list_volumes(self, params, marker=None, limit=None):
+        clean_params = {k: v for k, v in params.items() if v is not None}
+        search_opts, __ = self._search_opts(clean_params)
+
+        volume_ids = None
+        if clean_params.get('attached_host'):
+            host_uuid = str(uuid.uuid5(uuid.NAMESPACE_DNS,
+                                       clean_params['attached_host']))
+            attachments = self.backend.attachments.list(
+                search_opts={'instance_uuid': host_uuid})
+            volume_ids = set(a.volume_id for a in attachments)
+
+        min_size = clean_params.get('min_size', 0)
+        # Fetch one page at a time, so we don't have all volumes in memory
+        while True:
+            vs = self.backend.volumes.list(detailed=True,
+                                           search_opts=search_opts,
+                                           marker=marker,
+                                           limit=LIST_PAGE_SIZE,
+                                           sort='id:asc')
+            for vol in vs:
+                if (self._matches(vol, clean_params) and
+                        vol.size >= min_size and
+                        (volume_ids is None or vol.id in volume_ids)):
+                    yield vol
+
+            if len(vs) < LIST_PAGE_SIZE:
+                return
+            marker = vs[-1].id
+
+    def _poller(self, vol):
+        with self._poller_lock:
+            if not self._status_poller:
+                search_opts = {'metadata': {
+                    'backend': vol.metadata.get('backend')}}
+                self._status_poller = StatusPoller(self.backend, search_opts)
+        return self._status_poller
+
     def _wait(self, vol, states, delete_on_error=False):
+        deadline = time.time() + POLL_TIMEOUT
+        interval = POLL_INITIAL_INTERVAL
         while True:
             if vol.status in states:
                 return
@@ -178,8 +502,21 @@ class Volume(Resource, base.Volume):
                 if delete_on_error:
                     vol.force_delete()
                 self.fail('Volume is on error')
-            time.sleep(REFRESH_TIME)
-            vol = self.backend.volumes.get(vol.id)
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.fail('Timed out waiting for volume %s to be %s, it is '
+                          '%s' % (vol.id, ' or '.join(states) or 'deleted',
+                                  vol.status))
+            jitter = random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+            time.sleep(min(interval * jitter, remaining))
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+
+            volume_id = vol.id
+            vol = self._poller(vol).refresh(volume_id)
+            if vol is None:
+                raise exceptions.NotFound(404, 'Volume %s not found' %
+                                          volume_id)
 
     @Resource.state
     def present(self, params):
@@ -286,6 +623,11 @@ class Volume(Resource, base.Volume):
         return result
 
 
+@Resource.register
+class Job(Resource, base.Job):
+    pass
+
+
 def main():
     # This instantiates a resource and checks provided parameters
     resource = Resource.resource_factory()
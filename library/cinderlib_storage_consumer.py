@@ -20,12 +20,15 @@ import errno
 import functools
 import json
 import os
+import socket
 import sqlite3
+import time
 import traceback
 
 # from ansible.module_utils.
 from ansible.module_utils import basic
 from ansible.module_utils.storage import common
+from ansible.module_utils.storage import utils
 
 import six
 
@@ -38,6 +41,29 @@ from oslo_utils import fileutils
 from oslo_utils import strutils
 
 
+# Phases of the request, replaced in main when timings are requested
+TIMINGS = utils.Timings(enabled=False)
+
+# Connector properties are cached in the home directory unless configured
+DEFAULT_CONNECTOR_CACHE_FILE = '.storage_cinderlib_connector.json'
+DEFAULT_CONNECTOR_CACHE_TTL = 24 * 60 * 60
+# Changes to these files make the cached connector properties stale:
+# initiator name, NVMe host NQN and id, and multipath config and daemon.
+CONNECTOR_SOURCES = ('/etc/iscsi/initiatorname.iscsi', '/etc/nvme/hostnqn',
+                     '/etc/nvme/hostid', '/etc/multipath.conf',
+                     '/run/multipathd.pid', '/var/run/multipathd.pid')
+
+
+def _timed(phase):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TIMINGS.phase(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class RBDConnector(connectors.rbd.RBDConnector):
     """"Connector class to attach/detach RBD volumes locally.
 
@@ -224,16 +250,55 @@ def _execute(*cmd, **kwargs):
             cmd=sanitized_cmd, description=six.text_type(e))
 
 
-def attach_volume(db, module):
-    conn = _get_data(db, module)
-    if conn:
-        path = conn['device'].pop('path')
-        return {'changed': False,
-                'path': path,
-                'type': common.BLOCK,
-                'additional_data': conn['device']}
+def _get_connector(data, scan_attempts=3):
+    connector_dict = data['connector']
+    protocol = data[common.CONNECTION_INFO]['driver_volume_type']
+    # NOTE(geguileo): afaik only remotefs uses connection info
+    return connector.InitiatorConnector.factory(
+        protocol, 'sudo', user_multipath=connector_dict['multipath'],
+        device_scan_attempts=scan_attempts, conn=connector_dict)
 
-    params = module.params
+
+@_timed('check_device')
+def _is_valid(conn, path):
+    try:
+        return conn.check_valid_device(path)
+    except Exception:
+        return False
+
+
+class VolumeFailure(Exception):
+    pass
+
+
+class _Item(object):
+    """Module stand-in with the parameters of a volume in a batch request."""
+    def __init__(self, params):
+        self.params = params
+        # Existing attachment, or the exception raised looking it up
+        self.conn = None
+        # Existing attachment is no longer valid and is being replaced
+        self.stale = False
+
+    def fail_json(self, msg, **kwargs):
+        raise VolumeFailure(msg)
+
+
+def _check_attachment(conn):
+    """Return the result for an existing attachment, or None if not valid."""
+    path = conn['device'].get('path')
+    if not _is_valid(_get_connector(conn), path):
+        return None
+    additional_data = conn['device'].copy()
+    additional_data.pop('path')
+    return {'changed': False,
+            'path': path,
+            'type': common.BLOCK,
+            'additional_data': additional_data}
+
+
+def _connect(params):
+    """Connect the volume, return the result and the attachment's data."""
     conn_info = params[common.CONNECTION_INFO]['conn']
     connector_dict = params[common.CONNECTION_INFO]['connector']
     protocol = conn_info['driver_volume_type']
@@ -243,14 +308,12 @@ def attach_volume(db, module):
         protocol, 'sudo', user_multipath=connector_dict['multipath'],
         device_scan_attempts=params.get('scan_attempts', 3),
         conn=connector_dict)
-    device = conn.connect_volume(conn_info['data'])
-    try:
-        unavailable = not conn.check_valid_device(device.get('path'))
-    except Exception:
-        unavailable = True
+    with TIMINGS.phase('connect'):
+        device = conn.connect_volume(conn_info['data'])
+    unavailable = not _is_valid(conn, device.get('path'))
 
     if unavailable:
-        module.fail_json(msg='Unable to access backend storage once attached.')
+        raise VolumeFailure('Unable to access backend storage once attached.')
 
     additional_data = device.copy()
     additional_data.pop('path')
@@ -258,20 +321,116 @@ def attach_volume(db, module):
     data = {'device': device, common.CONNECTION_INFO: conn_info,
             'connector': connector_dict}
 
-    params['id'] = conn_info['data']['volume_id']
+    result = {'path': device['path'],
+              'type': common.BLOCK,
+              'additional_data': additional_data,
+              'changed': True}
+    return result, data
+
+
+def attach_volume(db, module):
+    params = module.params
+    if params.get('volumes') is not None:
+        return attach_volumes(db, module)
+
+    # Without connection info we only report existing valid attachments
+    lookup = not params.get(common.CONNECTION_INFO)
+    conn = _get_data(db, module, fail_on_multiple=not lookup)
+    if conn:
+        result = _check_attachment(conn)
+        if result:
+            return result
+        # Forget the stale attachment so we can connect it again
+        if not lookup:
+            _delete_attachment(db, module)
+
+    if lookup:
+        return {'changed': False, 'attached': False}
+
+    try:
+        result, data = _connect(params)
+    except VolumeFailure as exc:
+        module.fail_json(msg=str(exc))
+
+    params['id'] = params[common.CONNECTION_INFO]['conn']['data']['volume_id']
     _save_attachment(db, params, data)
+    return result
 
-    return {'path': device['path'],
-            'type': common.BLOCK,
-            'additional_data': additional_data,
-            'changed': True}
 
+def _batch_items(db, module):
+    """Return the volumes of a batch request with their attachments.
 
-def detach_volume(db, module):
-    data = _get_data(db, module)
-    if not data:
-        return {'changed': False}
+    Attachments are looked up here because the database can only be used from
+    this thread.
+    """
+    params = {k: v for k, v in module.params.items()
+              if k not in ('volumes', 'max_workers')}
+    items = []
+    for volume in module.params['volumes']:
+        item_params = params.copy()
+        item_params.update((k, v) for k, v in volume.items() if k in params)
+        item = _Item(item_params)
+        # Without connection info we only report existing valid attachments
+        lookup = (params['state'] == 'connected' and
+                  not item_params.get(common.CONNECTION_INFO))
+        try:
+            item.conn = _get_data(db, item, fail_on_multiple=not lookup)
+        except VolumeFailure as exc:
+            item.conn = exc
+        items.append(item)
+    return items
+
+
+def _batch_result(volumes, results):
+    for volume, result in zip(volumes, results):
+        result['item'] = volume
+    return {'changed': any(r.get('changed') for r in results),
+            'failed_count': len([r for r in results if r.get('failed')]),
+            'results': results}
+
+
+def attach_volumes(db, module):
+    """Connect multiple volumes concurrently.
+
+    OS-Brick spends most of the time of a connection scanning and waiting for
+    the device, so we connect them, and check existing attachments, in
+    parallel.  All the attachments are stored in a single transaction.
+    """
+    items = _batch_items(db, module)
+
+    def attach(item):
+        try:
+            if isinstance(item.conn, Exception):
+                raise item.conn
+            if item.conn:
+                result = _check_attachment(item.conn)
+                if result:
+                    return result, None
+            if not item.params.get(common.CONNECTION_INFO):
+                return {'changed': False, 'attached': False}, None
+            # Stale attachment is forgotten even if connecting fails
+            item.stale = bool(item.conn)
+            return _connect(item.params)
+        except Exception as exc:
+            return {'failed': True, 'changed': False, 'msg': str(exc)}, None
+
+    results = utils.concurrent_map(attach, items,
+                                   module.params['max_workers'])
+
+    for item, (result, data) in zip(items, results):
+        if item.stale:
+            _delete_attachment(db, item, commit=False)
+        if data:
+            conn_info = item.params[common.CONNECTION_INFO]['conn']
+            item.params['id'] = conn_info['data']['volume_id']
+            _save_attachment(db, item.params, data, commit=False)
+    db.commit()
 
+    return _batch_result(module.params['volumes'],
+                         [result for result, __ in results])
+
+
+def _disconnect(data):
     connector_dict = data['connector']
     conn_info = data[common.CONNECTION_INFO]
     protocol = conn_info['driver_volume_type']
@@ -280,15 +439,76 @@ def detach_volume(db, module):
     conn = connector.InitiatorConnector.factory(
         protocol, 'sudo', user_multipath=connector_dict['multipath'],
         device_scan_attempts=3, conn=connector_dict)
-    conn.disconnect_volume(conn_info['data'], device, force=False,
-                           ignore_errors=False)
+    with TIMINGS.phase('disconnect'):
+        conn.disconnect_volume(conn_info['data'], device, force=False,
+                               ignore_errors=False)
+
+
+def detach_volume(db, module):
+    if module.params.get('volumes') is not None:
+        return detach_volumes(db, module)
+
+    data = _get_data(db, module)
+    if not data:
+        return {'changed': False}
+
+    _disconnect(data)
     _delete_attachment(db, module)
     return {'changed': True}
 
 
+def _detach_items(db, items, max_workers):
+    """Disconnect the attachments of the items concurrently.
+
+    Disconnected attachments are removed in a single transaction.
+    """
+    def detach(item):
+        try:
+            if isinstance(item.conn, Exception):
+                raise item.conn
+            if not item.conn:
+                return {'changed': False}
+            _disconnect(item.conn)
+            return {'changed': True}
+        except Exception as exc:
+            return {'failed': True, 'changed': False, 'msg': str(exc)}
+
+    results = utils.concurrent_map(detach, items, max_workers)
+    for item, result in zip(items, results):
+        if result['changed']:
+            _delete_attachment(db, item, commit=False)
+    db.commit()
+    return results
+
+
+def detach_volumes(db, module):
+    """Disconnect multiple volumes concurrently."""
+    items = _batch_items(db, module)
+    results = _detach_items(db, items, module.params['max_workers'])
+    return _batch_result(module.params['volumes'], results)
+
+
+def evacuate(db, module):
+    """Disconnect all the attached volumes that match the filters.
+
+    The result of each volume has the volume's information in the item key,
+    so the controller can be told to unmap them.
+    """
+    items = []
+    volumes = []
+    for volume, data in _get_attachments(db, module.params):
+        item = _Item({'id': volume['id'], 'provider': volume['provider']})
+        item.conn = data
+        items.append(item)
+        volumes.append(volume)
+    results = _detach_items(db, items, module.params['max_workers'])
+    return _batch_result(volumes, results)
+
+
 def _validate_volume(module):
     specs = module.argument_spec.copy()
-    specs.update(state={'choices': ('connected', 'disconnected', 'extended'),
+    specs.update(state={'choices': ('connected', 'disconnected', 'extended',
+                                    'evacuated'),
                         'required': True},
                  provider={'type': 'str'},
                  backend={'type': 'str'},
@@ -300,7 +520,16 @@ def _validate_volume(module):
                  attached_host={'type': 'str', 'default': ''})
 
     if module.params.get('state') == 'connected':
-        specs[common.CONNECTION_INFO] = {'type': 'dict', 'required': True}
+        # Connection info is not passed when checking existing attachments
+        specs[common.CONNECTION_INFO] = {'type': 'dict'}
+
+    if module.params.get('state') in ('connected', 'disconnected'):
+        specs['volumes'] = {'type': 'list'}
+
+    if module.params.get('state') in ('connected', 'disconnected',
+                                      'evacuated'):
+        specs['max_workers'] = {'type': 'int',
+                                'default': utils.DEFAULT_MAX_WORKERS}
 
     if module.params.get('state') == 'extended':
         specs['new_size'] = {'type': 'int', 'required': True}
@@ -309,62 +538,123 @@ def _validate_volume(module):
     return new_module
 
 
-DB_FIELDS = ('id', 'name', 'provider', 'backend', 'host', 'size', 'data')
+DB_FIELDS = ('id', 'name', 'provider', 'backend', 'host', 'host_backend',
+             'size', 'data')
+DB_SCHEMA_VERSION = 1
+# Seconds to wait for the locks of other tasks running on the node
+DB_TIMEOUT = 30
+
+
+def _split_host(host):
+    """Return the node and the backend parts of a volume's host."""
+    node, __, backend = (host or '').partition('@')
+    return node, backend or None
 
 
+def _create_db(db):
+    """Create the attachments table or upgrade the unversioned one."""
+    # Python 2 would commit the transaction before running the DDL statements
+    db.isolation_level = None
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        # Another task may have created it while we waited for the lock
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version < DB_SCHEMA_VERSION:
+            old = db.execute("SELECT name FROM sqlite_master WHERE "
+                             "type='table' AND name='attachments'").fetchone()
+            if old:
+                db.execute('ALTER TABLE attachments RENAME TO old_attachments')
+
+            db.execute('CREATE TABLE attachments (id TEXT PRIMARY KEY, '
+                       'name TEXT, provider TEXT, backend TEXT, host TEXT, '
+                       'host_backend TEXT, size INTEGER, data TEXT)')
+            db.execute('CREATE INDEX attachments_name ON attachments (name)')
+            db.execute('CREATE INDEX attachments_backend ON attachments '
+                       '(provider, backend)')
+            db.execute('CREATE INDEX attachments_host ON attachments '
+                       '(host, host_backend)')
+
+            if old:
+                rows = db.execute('SELECT id, name, provider, backend, host, '
+                                  'size, data FROM old_attachments')
+                for (vol_id, name, provider, backend, host, size,
+                     data) in rows.fetchall():
+                    node, host_backend = _split_host(host)
+                    db.execute('INSERT OR REPLACE INTO attachments VALUES '
+                               '(?, ?, ?, ?, ?, ?, ?, ?)',
+                               (vol_id, name, provider, backend, node,
+                                host_backend, int(size) if size else size,
+                                data))
+                db.execute('DROP TABLE old_attachments')
+            db.execute('PRAGMA user_version = %d' % DB_SCHEMA_VERSION)
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    finally:
+        db.isolation_level = ''
+
+
+@_timed('db')
 def _setup_db(params):
     config = params[common.STORAGE_DATA][common.CONSUMER_CONFIG]
-    db = sqlite3.connect(config['db_file'])
-    cursor = db.cursor()
-    fields = ' TEXT,'.join(DB_FIELDS) + ' TEXT'
-    cursor.execute('CREATE TABLE IF NOT EXISTS attachments (' + fields + ')')
-    db.commit()
-    cursor.close()
+    # Relative paths are in the home directory, not where the module runs
+    db_file = os.path.join(os.path.expanduser('~'),
+                           os.path.expanduser(config['db_file']))
+    db = sqlite3.connect(db_file, timeout=DB_TIMEOUT)
+    # Readers don't block writers, so parallel tasks don't collide
+    db.execute('PRAGMA journal_mode=WAL')
+    if db.execute('PRAGMA user_version').fetchone()[0] < DB_SCHEMA_VERSION:
+        _create_db(db)
     return db
 
 
-def _save_attachment(db, params, data):
-    data = json.dumps(data)
-    values = tuple(six.text_type(params[k]) if params[k] else params[k]
-                   for k in DB_FIELDS[:-1]) + (data,)
-    fields = ','.join('?' * len(DB_FIELDS))
+@_timed('db')
+def _save_attachment(db, params, data, commit=True):
+    values = {k: six.text_type(params[k]) if params[k] else params[k]
+              for k in ('id', 'name', 'provider', 'backend')}
+    values['host'], values['host_backend'] = _split_host(params['host'])
+    values['size'] = int(params['size']) if params['size'] else None
+    values['data'] = json.dumps(data)
+    fields = ','.join(':' + k for k in DB_FIELDS)
     cursor = db.cursor()
-    cursor.execute('INSERT INTO attachments VALUES (%s)' % fields, values)
-    db.commit()
+    cursor.execute('INSERT OR REPLACE INTO attachments VALUES (%s)' % fields,
+                   values)
+    if commit:
+        db.commit()
     cursor.close()
 
 
+@_timed('db')
 def _update_attachment_size(db, vol_id, new_size):
     cursor = db.cursor()
-    cursor.execute('UPDATE attachments SET size=%s WHERE id="%s"' %
+    cursor.execute('UPDATE attachments SET size=? WHERE id=?',
                    (new_size, vol_id))
     db.commit()
     cursor.close()
 
 
 def __generate_where(params):
-    def _partial(field):
-        if field == 'host':
-            res = '%s LIKE :%s%@%'
-        else:
-            res = '%s=:%s'
-        return res % (field, field)
-
     filters = {k: params[k] for k in ('id', 'name', 'provider', 'backend',
-                                      'name', 'size')
+                                      'size')
                if params.get(k)}
+    # The host of the volume may include the backend and pool
+    if params.get('host'):
+        filters['host'], host_backend = _split_host(params['host'])
+        if host_backend:
+            filters['host_backend'] = host_backend
 
     if filters:
-        query_str = ' WHERE ' + ' and '.join(_partial(f) for f in filters)
+        query_str = ' WHERE ' + ' and '.join('%s=:%s' % (f, f)
+                                             for f in sorted(filters))
     else:
         query_str = ''
-    if filters.get('host'):
-        filters['host'] = filters['host'] + '@%'
 
     return query_str, filters
 
 
-def _get_data(db, module, fail_on_missing=False):
+@_timed('db')
+def _get_data(db, module, fail_on_missing=False, fail_on_multiple=True):
     query_str = 'SELECT data FROM attachments'
     where_str, filters = __generate_where(module.params)
     cursor = db.cursor()
@@ -377,11 +667,30 @@ def _get_data(db, module, fail_on_missing=False):
         return None
 
     if len(results) > 1:
+        if not fail_on_multiple:
+            return None
         module.fail_json(msg='Multiple attachments found')
 
     return results[0]
 
 
+@_timed('db')
+def _get_attachments(db, params):
+    """Return the volume information and data of matching attachments."""
+    query_str = ('SELECT id, name, provider, backend, host, data '
+                 'FROM attachments')
+    where_str, filters = __generate_where(params)
+    cursor = db.cursor()
+    cursor.execute(query_str + where_str, filters)
+    results = [({'id': vol_id, 'name': name, 'provider': provider,
+                 'backend': backend, 'host': host}, json.loads(data))
+               for vol_id, name, provider, backend, host, data
+               in cursor.fetchall()]
+    cursor.close()
+    return results
+
+
+@_timed('db')
 def _get_size(db, module):
     query_str = 'SELECT size FROM attachments'
     where_str, filters = __generate_where(module.params)
@@ -390,12 +699,14 @@ def _get_size(db, module):
     return int(cursor.fetchone()[0])
 
 
-def _delete_attachment(db, module):
+@_timed('db')
+def _delete_attachment(db, module, commit=True):
     query_str = 'DELETE FROM attachments'
     where_str, filters = __generate_where(module.params)
     cursor = db.cursor()
     cursor.execute(query_str + where_str, filters)
-    db.commit()
+    if commit:
+        db.commit()
     cursor.close()
 
 
@@ -414,7 +725,8 @@ def extend_volume(db, module):
         conn = connector.InitiatorConnector.factory(
             protocol, 'sudo', user_multipath=connector_dict['multipath'],
             device_scan_attempts=3, conn=connector_dict)
-        new_size = conn.extend_volume(conn_info['data'])
+        with TIMINGS.phase('extend'):
+            new_size = conn.extend_volume(conn_info['data'])
         # Extend returns the size in bytes, convert to GB
         new_size = int(round(new_size / 1024.0 / 1024.0 / 1024.0))
 
@@ -430,27 +742,73 @@ def extend_volume(db, module):
 def volume(module):
     methods = {'connected': attach_volume,
                'disconnected': detach_volume,
-               'extended': extend_volume}
-    new_module = _validate_volume(module)
+               'extended': extend_volume,
+               'evacuated': evacuate}
+    with TIMINGS.phase('validate'):
+        new_module = _validate_volume(module)
     db = _setup_db(module.params)
     method = methods[new_module.params['state']]
     result = method(db, new_module)
     return result
 
 
+def _connector_fingerprint(params):
+    """Return what the connector properties of the node depend on."""
+    sources = {}
+    for path in CONNECTOR_SOURCES:
+        try:
+            st = os.stat(path)
+            sources[path] = [st.st_ino, st.st_size, st.st_mtime]
+        except OSError:
+            sources[path] = None
+    return {'ips': params['ips'],
+            'multipath': params['multipath'],
+            'enforce_multipath': params['enforce_multipath'],
+            'hostname': socket.gethostname(),
+            'sources': sources}
+
+
 def node(module):
     specs = module.argument_spec
     specs.update(ips={'type': 'list', 'required': True},
                  multipath={'type': 'bool', 'default': True},
-                 enforce_multipath={'type': 'bool', 'default': False})
+                 enforce_multipath={'type': 'bool', 'default': False},
+                 refresh={'type': 'bool', 'default': False})
     module = basic.AnsibleModule(module.argument_spec,
                                  check_invalid_arguments=True)
+    params = module.params
 
-    connector_dict = connector.get_connector_properties(
-        root_helper='sudo',
-        my_ip=module.params['ips'][0],
-        multipath=module.params['multipath'],
-        enforce_multipath=module.params['enforce_multipath'])
+    config = (params[common.STORAGE_DATA] or {}).get(common.CONSUMER_CONFIG)
+    config = config or {}
+    cache_file = os.path.join(
+        os.path.expanduser('~'),
+        os.path.expanduser(config.get('connector_cache_file') or
+                           DEFAULT_CONNECTOR_CACHE_FILE))
+    ttl = config.get('connector_cache_ttl', DEFAULT_CONNECTOR_CACHE_TTL)
+
+    # Discovering the properties runs multiple commands on the node
+    fingerprint = _connector_fingerprint(params)
+    cached = not params['refresh'] and ttl and utils.read_json(cache_file)
+    if (cached and cached.get('fingerprint') == fingerprint and
+            0 <= time.time() - cached.get('cached_at', 0) < ttl):
+        return {common.STORAGE_DATA: {
+            common.CONNECTOR_DICT: cached['connector_dict']}}
+
+    with TIMINGS.phase('connector_properties'):
+        connector_dict = connector.get_connector_properties(
+            root_helper='sudo',
+            my_ip=params['ips'][0],
+            multipath=params['multipath'],
+            enforce_multipath=params['enforce_multipath'])
+
+    if ttl:
+        try:
+            utils.write_json(cache_file, {'fingerprint': fingerprint,
+                                          'connector_dict': connector_dict,
+                                          'cached_at': time.time()})
+        except (IOError, OSError):
+            # We'll discover them again next time
+            pass
     return {common.STORAGE_DATA: {common.CONNECTOR_DICT: connector_dict}}
 
 
@@ -500,15 +858,22 @@ def main():
         argument_spec={
             'resource': {'required': True, 'choices': ('node', 'volume')},
             common.STORAGE_DATA: {'type': 'dict', 'options': consumer_config},
+            'timings': {'type': 'bool', 'default': False},
         },
         supports_check_mode=False,
         check_invalid_arguments=False,
     )
 
-    _set_priv_helper('sudo')
+    global TIMINGS
+    TIMINGS = utils.Timings(module.params['timings'])
+    with TIMINGS.phase('setup'):
+        _set_priv_helper('sudo')
 
     method = globals()[module.params['resource']]
-    module.exit_json(**method(module))
+    result = method(module)
+    if TIMINGS.enabled:
+        result['storage_timings'] = TIMINGS.result()
+    module.exit_json(**result)
 
 
 if __name__ == '__main__':
@@ -17,20 +17,118 @@
 #
 
 import errno
+import heapq
+import json
 import os
+import sqlite3
+import threading
 
 # from ansible.module_utils.
 # from ansible.module_utils import basic
 
 from ansible.module_utils.storage import base
 from ansible.module_utils.storage import common
+from ansible.module_utils.storage import service
+from ansible.module_utils.storage import utils
 
 import cinderlib
 
 HOME = os.path.expanduser("~")
 
+# Initialized backends, only reused when running as a service
+BACKENDS = {}
+# cinderlib can only be set up once per process, with this provider config
+SETUP_CONFIG = None
+_SETUP_LOCK = threading.Lock()
+
+
+class VolumeIndex(object):
+    """Index of volume and connection ids stored on the controller.
+
+    cinderlib persistence can only look up volumes by id and name, so finding
+    a volume by its host, or a connection by its attached host, means going
+    through all of them.  The index has the ids of volumes by backend and
+    host, and of connections by volume and attached host.
+
+    Entries are only hints that are always checked against the persistence,
+    which is searched on misses.  Volumes created by other means are missing
+    from the index, so it's only used to look up volumes by host once a full
+    search of the backend has found them all, and even then a miss means
+    searching the whole backend again.
+    """
+    FILENAME = 'storage_cinderlib_index.sqlite'
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._complete = set()
+        self.db = sqlite3.connect(os.path.join(path, self.FILENAME),
+                                  timeout=60, check_same_thread=False)
+        with self._lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS volumes (id TEXT '
+                            'PRIMARY KEY, backend TEXT, name TEXT, host '
+                            'TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS volumes_host ON '
+                            'volumes (backend, host)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS connections '
+                            '(volume_id TEXT, attached_host TEXT, id TEXT, '
+                            'PRIMARY KEY (volume_id, attached_host))')
+            # Backends with all their volumes in the index
+            self.db.execute('CREATE TABLE IF NOT EXISTS complete (backend '
+                            'TEXT PRIMARY KEY)')
+
+    def _execute(self, query, args=()):
+        with self._lock, self.db:
+            return self.db.execute(query, args).fetchall()
+
+    def volume_ids(self, backend, host):
+        rows = self._execute('SELECT id FROM volumes WHERE backend=? and '
+                             'host=?', (backend, host))
+        return [row[0] for row in rows]
+
+    def complete(self, backend):
+        # Full searches refresh the index but never make it incomplete
+        if backend not in self._complete:
+            if self._execute('SELECT 1 FROM complete WHERE backend=?',
+                             (backend,)):
+                self._complete.add(backend)
+        return backend in self._complete
+
+    def set_volumes(self, backend, vols):
+        """Replace the volumes of a backend with all its volumes."""
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM volumes WHERE backend=?', (backend,))
+            self.db.executemany('INSERT OR REPLACE INTO volumes VALUES (?, ?, '
+                                '?, ?)', [(vol.id, backend, vol.name, vol.host)
+                                          for vol in vols])
+            self.db.execute('INSERT OR REPLACE INTO complete VALUES (?)',
+                            (backend,))
+
+    def add_volume(self, backend, vol):
+        self._execute('INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?)',
+                      (vol.id, backend, vol.name, vol.host))
+
+    def delete_volume(self, volume_id):
+        self._execute('DELETE FROM volumes WHERE id=?', (volume_id,))
+        self._execute('DELETE FROM connections WHERE volume_id=?',
+                      (volume_id,))
+
+    def connection_id(self, volume_id, attached_host):
+        rows = self._execute('SELECT id FROM connections WHERE volume_id=? '
+                             'and attached_host=?', (volume_id, attached_host))
+        return rows[0][0] if rows else None
+
+    def add_connection(self, volume_id, attached_host, connection_id):
+        self._execute('INSERT OR REPLACE INTO connections VALUES (?, ?, ?)',
+                      (volume_id, attached_host, connection_id))
+
+    def delete_connection(self, volume_id, attached_host):
+        self._execute('DELETE FROM connections WHERE volume_id=? and '
+                      'attached_host=?', (volume_id, attached_host))
+
 
 class Resource(base.Resource):
+    RESOURCES = {}
+
     def __init__(self, *args, **kwargs):
         # If at some point we have a base class that overwrites __init__ we can
         # use this to call it.
@@ -42,16 +140,45 @@ class Resource(base.Resource):
         # else:
         #     super(Resource, self).__init__(*args, **kwargs)
         super(Resource, self).__init__(*args, **kwargs)
-        self.backend = self._setup(self.storage_data)
+        self.backend = None
+        if self.NEEDS_BACKEND:
+            self.backend = self._setup(self.storage_data)
 
     def _setup(self, storage_data):
         if not storage_data:
             return None
 
-        cinderlib.setup(**storage_data[common.PROVIDER_CONFIG])
-        backend = cinderlib.Backend(**storage_data[common.BACKEND_CONFIG])
+        key = json.dumps(storage_data, sort_keys=True)
+        backend = BACKENDS.get(key)
+        if not backend:
+            self._global_setup(storage_data[common.PROVIDER_CONFIG])
+            backend = cinderlib.Backend(**storage_data[common.BACKEND_CONFIG])
+            BACKENDS[key] = backend
         return backend
 
+    @staticmethod
+    def _global_setup(provider_config):
+        """Set up cinderlib unless it already is with the same config.
+
+        A second setup raises an exception in cinderlib, so backends with a
+        different provider config must run in another process.
+        """
+        global SETUP_CONFIG
+        with _SETUP_LOCK:
+            if not getattr(cinderlib.Backend, 'global_initialization', False):
+                cinderlib.setup(**provider_config)
+                SETUP_CONFIG = provider_config
+            elif provider_config != SETUP_CONFIG:
+                raise service.Rejected('cinderlib is already set up in this '
+                                       'process with a different provider '
+                                       'configuration')
+
+    @property
+    def locks_path(self):
+        if not self.storage_data:
+            return super(Resource, self).locks_path
+        return self.storage_data[common.PROVIDER_CONFIG]['locks_path']
+
     def execute(self, params):
         # Check that the backend matches our own
         if (self.backend and params.get('backend') and
@@ -74,11 +201,13 @@ class Backend(Resource, base.Backend):
         'use_stderr': {'type': 'bool', 'default': False},
         'debug': {'type': 'bool', 'default': False},
         'verbose': {'type': 'bool', 'default': False},
-        'db_file': {'type': 'path', 'default': DEFAULT_DB_FILE},
+        # Expanded on the consumer, relative paths are in its home directory
+        'db_file': {'type': 'str', 'default': DEFAULT_DB_FILE},
         'locks_path': {'type': 'path', 'default': DEFAULT_LOCKS_PATH},
         'persistence_config': {'type': 'dict',
                                'default': DEFAULT_PERSISTENCE},
         'disable_sudo': {'type': 'bool', 'default': False},
+        'service_socket': {'type': 'path', 'default': ''},
     }
     BACKEND_CONFIG_SPECS = {
         'volume_driver': {'type': 'str'},
@@ -97,10 +226,12 @@ class Backend(Resource, base.Backend):
 
         # Set consumer config
         db_file = provider_config.pop('db_file')
+        service_socket = provider_config.pop('service_socket')
         self.makedirs(provider_config['locks_path'])
 
         storage_data = {common.PROVIDER_CONFIG: provider_config,
-                        common.BACKEND_CONFIG: backend_config}
+                        common.BACKEND_CONFIG: backend_config,
+                        common.SERVICE_SOCKET: service_socket}
 
         self._setup(storage_data)
 
@@ -113,10 +244,8 @@ class Backend(Resource, base.Backend):
         }
         return result
 
-    @Resource.state
-    def stats(self, params):
-        stats = self.backend.stats(refresh=True)
-        return {'changed': False, 'result': stats}
+    def _get_stats(self):
+        return self.backend.stats(refresh=True)
 
     @Resource.state
     def absent(self, params):
@@ -144,17 +273,54 @@ class Volume(Resource, base.Volume):
         res['backend'] = vol.cluster_name.split('@')[0]
         return res
 
-    def _matches(self, vol, params):
+    @property
+    def index(self):
+        if not getattr(self, '_index', None):
+            utils.makedirs(self.locks_path)
+            self._index = VolumeIndex(self.locks_path)
+        return self._index
+
+    def _matches(self, vol, params, sizes=None):
         for k, v in self.FIELDS_MAP.items():
-            if params.get(k) and getattr(vol, v) != params[k]:
+            if k == 'size' and sizes:
+                if vol.size not in sizes:
+                    return False
+            elif params.get(k) and getattr(vol, v) != params[k]:
                 return False
         return True
 
-    def _get_volume(self, params, fail_not_found=False):
-        vs = self.backend.persistence.get_volumes(volume_id=params['id'],
-                                                  volume_name=params['name'],
-                                                  backend_name=self.backend.id)
-        filtered_vs = [v for v in vs if self._matches(v, params)]
+    def _find_volumes(self, params, sizes=None):
+        persistence = self.backend.persistence
+        # Persistence looks up volumes by id and name, and the index is only
+        # used to find them by host when it has all the backend's volumes.
+        # Volumes created outside this controller are not in the index, so
+        # misses are confirmed with a full search before anyone creates a
+        # duplicate.
+        if (not params.get('id') and not params.get('name') and
+                self.index.complete(self.backend.id)):
+            vs = []
+            for volume_id in self.index.volume_ids(self.backend.id,
+                                                   params['host']):
+                found = persistence.get_volumes(volume_id=volume_id,
+                                                backend_name=self.backend.id)
+                if not found:
+                    self.index.delete_volume(volume_id)
+                vs.extend(v for v in found if self._matches(v, params, sizes))
+            if vs:
+                return vs
+
+        vs = persistence.get_volumes(volume_id=params['id'],
+                                     volume_name=params['name'],
+                                     backend_name=self.backend.id)
+        if not params.get('id') and not params.get('name'):
+            self.index.set_volumes(self.backend.id, vs)
+        filtered_vs = [v for v in vs if self._matches(v, params, sizes)]
+        for vol in filtered_vs:
+            self.index.add_volume(self.backend.id, vol)
+        return filtered_vs
+
+    def _get_volume(self, params, fail_not_found=False, sizes=None):
+        filtered_vs = self._find_volumes(params, sizes)
 
         if not filtered_vs:
             if fail_not_found:
@@ -166,6 +332,33 @@ class Volume(Resource, base.Volume):
 
         return filtered_vs[0]
 
+    def _list_volumes(self, params, marker=None, limit=None):
+        # Persistence has no paging, so we load the backend's volumes, but
+        # only sort the ones that make it into the page.
+        persistence = self.backend.persistence
+        vs = persistence.get_volumes(volume_id=params.get('id'),
+                                     volume_name=params.get('name'),
+                                     backend_name=self.backend.id)
+
+        volume_ids = None
+        if params.get('attached_host'):
+            volume_ids = set(c.volume_id
+                             for c in persistence.get_connections()
+                             if c.attached_host == params['attached_host'])
+
+        host = params.get('host') and '%s@' % params['host']
+        size = params.get('size')
+        min_size = params.get('min_size')
+        vs = (v for v in vs
+              if ((not marker or v.id > marker) and
+                  (volume_ids is None or v.id in volume_ids) and
+                  (not host or v.host.startswith(host)) and
+                  (not size or v.size == size) and
+                  (not min_size or v.size >= min_size)))
+        if limit:
+            return heapq.nsmallest(limit, vs, key=lambda v: v.id)
+        return sorted(vs, key=lambda v: v.id)
+
     def _prepare_params(self, params):
         new_params = params.copy()
         pool_name = self.backend.pool_names[0]
@@ -187,6 +380,7 @@ class Volume(Resource, base.Volume):
             vol = self.backend.create_volume(
                 size=params['size'], name=params['name'], id=params['id'],
                 host=params['host'], cluster_name=params['cluster_name'])
+            self.index.add_volume(self.backend.id, vol)
         result.update(self._to_json(vol))
         return result
 
@@ -196,12 +390,22 @@ class Volume(Resource, base.Volume):
         vol = self._get_volume(params)
         if vol:
             vol.delete()
+            self.index.delete_volume(vol.id)
 
         return {'changed': bool(vol)}
 
     def _get_connection(self, volume, host):
+        connection_id = self.index.connection_id(volume.id, host)
+        if connection_id:
+            cs = self.backend.persistence.get_connections(
+                connection_id=connection_id)
+            if cs and cs[0].attached_host == host:
+                return cs[0]
+            self.index.delete_connection(volume.id, host)
+
         for c in volume.connections:
             if c.attached_host == host:
+                self.index.add_connection(volume.id, host, c.id)
                 return c
         return None
 
@@ -214,6 +418,8 @@ class Volume(Resource, base.Volume):
         if not connection:
             connection = vol.connect(params['connector_dict'],
                                      attached_host=params['attached_host'])
+            self.index.add_connection(vol.id, params['attached_host'],
+                                      connection.id)
 
         # Returning the volume information allows consumer to disconnect even
         # if we pass different data on the task.
@@ -230,6 +436,7 @@ class Volume(Resource, base.Volume):
         connection = self._get_connection(vol, params['attached_host'])
         if connection:
             connection.disconnect()
+            self.index.delete_connection(vol.id, params['attached_host'])
 
         return {'changed': bool(connection)}
 
@@ -238,13 +445,9 @@ class Volume(Resource, base.Volume):
         params = self._prepare_params(params)
         new_size = params.pop('size')
         old_size = params.pop('old_size')
-        if old_size:
-            params['size'] = old_size
-        vol = self._get_volume(params)
         # The volume may have already been extended
-        if not vol and 'size' in params:
-            params['size'] = new_size
-            vol = self._get_volume(params, fail_not_found=True)
+        sizes = (old_size, new_size) if old_size else None
+        vol = self._get_volume(params, fail_not_found=True, sizes=sizes)
 
         if vol.size > new_size:
             raise Exception('Volumes cannot be shrinked')
@@ -266,7 +469,36 @@ class Volume(Resource, base.Volume):
         return result
 
 
+@Resource.register
+class Job(Resource, base.Job):
+    pass
+
+
+@Resource.register
+class Service(Resource, base.Service):
+    """Long lived process that keeps backends initialized between tasks."""
+    @Resource.state
+    def present(self, params):
+        pid = service.running(params['socket'])
+        result = {'changed': not pid}
+        if not pid:
+            try:
+                pid = service.start(params['socket'], Resource.run_args,
+                                    params['idle_timeout'])
+            except service.ServiceError as exc:
+                self.fail(str(exc))
+        result['pid'] = pid
+        return result
+
+    @Resource.state
+    def absent(self, params):
+        pid = service.stop(params['socket'])
+        return {'changed': bool(pid), 'pid': pid}
+
+
 def main():
+    # Let the controller service do the work if it's running
+    Resource.forward()
     # This instantiates a resource and checks provided parameters
     resource = Resource.resource_factory()
     result = resource.process()
@@ -14,47 +14,137 @@
 #    under the License.
 #
 
-import collections
 import datetime
+import itertools
 import json
-
+import os
+import sys
+import threading
+import time
+import traceback
+
+try:
+    from collections.abc import Set
+except ImportError:
+    from collections import Set
+
+from ansible.module_utils._text import to_bytes
 from ansible.module_utils import basic
+from ansible.module_utils.six import StringIO
 from ansible.module_utils.storage import common
+from ansible.module_utils.storage import jobs
+from ansible.module_utils.storage import service
+from ansible.module_utils.storage import stats as stats_cache
+from ansible.module_utils.storage import utils
 
 
 class _SetEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, collections.Set):
+        if isinstance(obj, Set):
             return list(obj)
         elif isinstance(obj, datetime.datetime):
             return obj.isoformat()
         return super(_SetEncoder, self).default(obj)
 
 
+class _ThreadOutput(object):
+    """Replacement for sys.stdout that captures output per thread.
+
+    Threads that haven't started a capture write to the original stdout.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._stdout = None
+
+    def start(self):
+        if sys.stdout is not self:
+            self._stdout = sys.stdout
+            sys.stdout = self
+        self._local.buffer = StringIO()
+
+    def stop(self):
+        output = self._local.buffer.getvalue()
+        self._local.buffer = None
+        return output
+
+    def write(self, data):
+        buf = getattr(self._local, 'buffer', None)
+        (buf or self._stdout).write(data)
+
+    def flush(self):
+        if not getattr(self._local, 'buffer', None):
+            self._stdout.flush()
+
+
+class ResourceFailure(Exception):
+    """Failure of a single item when processing a batch request."""
+    def __init__(self, msg, **kwargs):
+        super(ResourceFailure, self).__init__(msg)
+        self.result = kwargs
+        self.result['msg'] = msg
+
+
+_OUTPUT = _ThreadOutput()
+# Serializes access to the module arguments global variable
+_ARGS_LOCK = threading.Lock()
+
+
+def _captured(func):
+    """Call func, that exits the module, and return the module's result."""
+    _OUTPUT.start()
+    try:
+        func()
+    except SystemExit:
+        pass
+    except service.Rejected as exc:
+        return {'failed': True, 'changed': False, 'rejected': True,
+                'msg': str(exc)}
+    except Exception as exc:
+        return {'failed': True, 'changed': False, 'msg': str(exc),
+                'exception': traceback.format_exc()}
+    finally:
+        output = _OUTPUT.stop()
+    return json.loads(output)
+
+
 class Resource(object):
     RESOURCES = {}
     STATES = []
     DEFAULT_STATE = 'present'
+    # Parameter with the list of items for batch requests and states where
+    # batch requests are accepted.
+    BATCH_PARAM = None
+    BATCH_STATES = ()
+    # States that can run as background jobs
+    BACKGROUND_STATES = ()
+    # Whether the provider must initialize the backend for this resource
+    NEEDS_BACKEND = True
 
     def __init__(self, module, storage_data):
         self.module = module
         self.storage_data = storage_data
+        self.batch = False
+        self.item_specs = {}
+        self.timings = utils.Timings(enabled=False)
 
     @staticmethod
     def _pop_param(name):
         params = json.loads(basic._ANSIBLE_ARGS.decode('utf-8'))
         param = params['ANSIBLE_MODULE_ARGS'].pop(name, None)
-        basic._ANSIBLE_ARGS = json.dumps(params, encoding='utf-8',
-                                         cls=_SetEncoder)
+        basic._ANSIBLE_ARGS = to_bytes(json.dumps(params, cls=_SetEncoder))
         return param
 
     @staticmethod
     def register(new_class):
         resource = new_class.__name__.lower()
-        for name, method in new_class.__dict__.items():
-            new_class._set_state(name, method)
-
-        Resource.RESOURCES[resource] = new_class
+        # States can be defined in the base resources
+        for klass in reversed(new_class.__mro__):
+            for name, method in vars(klass).items():
+                new_class._set_state(name, method)
+
+        # Providers with their own RESOURCES don't collide when several
+        # providers are loaded in the same process.
+        new_class.RESOURCES[resource] = new_class
         return new_class
 
     @staticmethod
@@ -87,7 +177,11 @@ class Resource(object):
         specs = {'resource': {'choices': list(cls.RESOURCES.keys())},
                  'provider': {'type': 'str', 'choices': ['cinderlib',
                                                          'cinderclient']},
-                 'backend': {'type': 'str'}}
+                 'backend': {'type': 'str'},
+                 'background': {'type': 'bool', 'default': False},
+                 'jobs_path': {'type': 'path',
+                               'default': jobs.DEFAULT_JOBS_PATH},
+                 'timings': {'type': 'bool', 'default': False}}
 
         resource = params.get('resource')
         resource_class = cls.RESOURCES.get(resource)
@@ -98,9 +192,59 @@ class Resource(object):
         module = basic.AnsibleModule(specs,
                                      check_invalid_arguments=False,
                                      supports_check_mode=False)
-        resource = cls.RESOURCES[resource](module, storage_data)
+        timings = utils.Timings(module.params['timings'])
+        # Includes the provider's backend initialization
+        with timings.phase('setup'):
+            resource = cls.RESOURCES[resource](module, storage_data)
+        resource.timings = timings
         return resource
 
+    @classmethod
+    def run_args(cls, args):
+        """Run a request in this process and return the module result.
+
+        Module arguments are global, so only loading and validating them is
+        serialized, and the actual work can run concurrently in threads.
+        """
+        def run():
+            with _ARGS_LOCK:
+                original_args = basic._ANSIBLE_ARGS
+                basic._ANSIBLE_ARGS = to_bytes(
+                    json.dumps({'ANSIBLE_MODULE_ARGS': args}, cls=_SetEncoder))
+                try:
+                    resource = cls.resource_factory()
+                    with resource.timings.phase('validate'):
+                        params = resource.validate()
+                finally:
+                    basic._ANSIBLE_ARGS = original_args
+            resource.exit(**resource.execute(params))
+
+        return _captured(run)
+
+    @staticmethod
+    def forward():
+        """Pass the request to the controller service if it's running.
+
+        Exits the module with the service's result, and returns if there is no
+        service available.
+        """
+        params = basic._load_params()
+        storage_data = params.get(common.STORAGE_DATA) or {}
+        path = storage_data.get(common.SERVICE_SOCKET)
+        if not path or not os.path.exists(path):
+            return
+
+        try:
+            result = service.request(path, 'run', args=params)
+        except service.Unavailable:
+            return
+        # Service cannot handle this request, so we run it ourselves
+        if result.get('rejected'):
+            return
+
+        print(json.dumps(result, cls=_SetEncoder))
+        sys.exit(1 if result.get('failed') else 0)
+
     def validate(self):
         # We don't calculate this on init in case we want to do something in
         # the inheriting classes.
@@ -118,19 +262,107 @@ class Resource(object):
         params.pop('resource')
         params.pop('provider')
         state = params.pop('state')
+        background = params.pop('background', False)
+        params.pop('timings', None)
+        self.jobs_path = params.pop('jobs_path', jobs.DEFAULT_JOBS_PATH)
+
+        if background:
+            if state not in self.BACKGROUND_STATES:
+                self.fail('State %s cannot run in the background' % state)
+            job_id = jobs.start(self.jobs_path, lambda: _captured(
+                lambda: self.exit(**self._execute_state(state, params))))
+            return {'changed': False, 'started': True, 'job_id': job_id}
+        return self._execute_state(state, params)
+
+    def _execute_state(self, state, params):
+        # Other states handle batch parameters themselves
+        if state in self.BATCH_STATES:
+            items = params.pop(self.BATCH_PARAM, None)
+            max_workers = params.pop('max_workers', None)
+            if items is not None:
+                return self._execute_batch(state, params, items, max_workers)
+        return self._run_state(state, params)
+
+    @property
+    def locks_path(self):
+        return utils.DEFAULT_LOCKS_PATH
 
+    def lock_names(self, state, params):
+        """Return names of the resources locked while running the state."""
+        return []
+
+    def _run_state(self, state, params):
         executor = getattr(self, state)
-        return executor(params)
+        names = self.lock_names(state, params)
+        if not names:
+            with self.timings.phase(state):
+                return executor(params)
+
+        with utils.Locks(self.locks_path, names) as locks:
+            self.timings.add('lock_wait', locks.wait)
+            with self.timings.phase(state):
+                result = executor(params)
+        if result is not None:
+            result['lock_wait'] = round(locks.wait, 3)
+        return result
+
+    def _item_params(self, params, item):
+        if not isinstance(item, dict):
+            self.fail('Invalid item %s' % item)
+
+        unknown = set(item).difference(self.item_specs)
+        if unknown:
+            self.fail('Unsupported parameters for item: %s' %
+                      ', '.join(sorted(unknown)))
+
+        item_params = params.copy()
+        for key, value in item.items():
+            if value is not None and self.item_specs[key].get('type') == 'int':
+                value = int(value)
+            item_params[key] = value
+
+        for key, spec in self.item_specs.items():
+            if spec.get('required') and item_params.get(key) is None:
+                self.fail('missing required argument: %s' % key)
+        return item_params
+
+    def _execute_batch(self, state, params, items, max_workers):
+        # Failures on items must not exit the module
+        self.batch = True
+
+        def run_item(item):
+            try:
+                result = self._run_state(state,
+                                         self._item_params(params, item))
+            except ResourceFailure as exc:
+                result = exc.result
+            except Exception as exc:
+                result = {'failed': True, 'changed': False, 'msg': str(exc)}
+            result['item'] = item
+            return result
+
+        results = utils.concurrent_map(run_item, items, max_workers)
+        return {'changed': any(r.get('changed') for r in results),
+                'failed_count': len([r for r in results if r.get('failed')]),
+                'results': results}
 
     def process(self):
-        params = self.validate()
+        with self.timings.phase('validate'):
+            params = self.validate()
         return self.execute(params)
 
     def exit(self, *args, **kwargs):
+        if self.timings.enabled:
+            kwargs['storage_timings'] = self.timings.result()
         self.module.exit_json(*args, **kwargs)
 
     def fail(self, msg, *args, **kwargs):
         kwargs.setdefault('changed', False)
+        if self.batch:
+            kwargs['failed'] = True
+            raise ResourceFailure(msg, **kwargs)
+        if self.timings.enabled:
+            kwargs['storage_timings'] = self.timings.result()
         self.module.fail_json(msg=msg, *args, **kwargs)
 
     @property
@@ -139,8 +371,11 @@ class Resource(object):
 
 
 class Backend(Resource):
+    BACKGROUND_STATES = ('stats',)
     PROVIDER_CONFIG_SPECS = {}
     BACKEND_CONFIG_SPECS = {}
+    # Returned for each pool when requesting the stats of many backends
+    DEFAULT_STATS_FIELDS = ('total_capacity_gb', 'free_capacity_gb')
 
     def validate_present(self):
         specs = self.module.argument_spec.copy()
@@ -154,29 +389,189 @@ class Backend(Resource):
         self.module = basic.AnsibleModule(specs, check_invalid_arguments=False)
 
     def validate_stats(self):
+        specs = self.module.argument_spec.copy()
+        specs.update(max_age={'type': 'int', 'default': 0},
+                     background_refresh={'type': 'bool', 'default': False},
+                     stats_cache_path={
+                         'type': 'path',
+                         'default': stats_cache.DEFAULT_CACHE_PATH},
+                     backends={'type': 'list'},
+                     fields={'type': 'list'},
+                     max_workers={'type': 'int',
+                                  'default': utils.DEFAULT_MAX_WORKERS})
+        self.module = basic.AnsibleModule(specs, check_invalid_arguments=True)
+
+    def validate_absent(self):
         # We make sure there are no extra params
         specs = self.module.argument_spec
         self.module = basic.AnsibleModule(specs, check_invalid_arguments=True)
 
-    validate_absent = validate_stats
+    def _get_stats(self):
+        """Return the stats of the backend, requesting them to the storage."""
+        self.fail('Stats are not supported by this provider')
+
+    def _refresh_stats(self, path, key):
+        stats_cache.write(path, key, self._get_stats())
+        return {'changed': False, 'refreshed': True}
+
+    @Resource.state
+    def stats(self, params):
+        """Return the backend stats, from the cache if they are fresh enough.
+
+        With background_refresh stale stats are returned right away while new
+        ones are requested in the background.
+        """
+        if params.get('backends') is not None:
+            return self._backends_stats(params)
+
+        path = params['stats_cache_path']
+        key = stats_cache.cache_key(self.storage_data)
+        entry = stats_cache.read(path, key)
+        result = {'changed': False, 'cached': bool(entry)}
+
+        if entry and time.time() - entry['sampled_at'] <= params['max_age']:
+            pass
+        elif entry and params['background_refresh']:
+            if not stats_cache.refreshing(entry):
+                stats_cache.mark_refresh(path, key, entry)
+                result['refresh_job_id'] = jobs.start(
+                    self.jobs_path, lambda: self._refresh_stats(path, key))
+        else:
+            entry = stats_cache.write(path, key, self._get_stats())
+            result['cached'] = False
+
+        result.update(result=entry['stats'],
+                      sampled_at=entry['sampled_at'],
+                      age=round(time.time() - entry['sampled_at'], 3))
+        return result
+
+    @staticmethod
+    def _pools(stats):
+        """Return the stats of each pool including the backend's stats."""
+        if isinstance(stats, list):
+            return stats
+        pools = stats.get('pools')
+        if not pools:
+            return [stats]
+        backend_stats = {k: v for k, v in stats.items() if k != 'pools'}
+        return [dict(backend_stats, **pool) for pool in pools]
+
+    def _backends_stats(self, params):
+        """Return a table with the stats of each pool of many backends.
+
+        Backends are initialized one at a time, and then their stats are
+        requested concurrently.
+        """
+        items = params.pop('backends')
+        max_workers = params.pop('max_workers')
+        fields = params.pop('fields') or self.DEFAULT_STATS_FIELDS
+
+        resources = []
+        for item in items:
+            try:
+                resource = type(self)(self.module, item[common.STORAGE_DATA])
+            except Exception as exc:
+                resource = exc
+            else:
+                # Failures must not exit the module
+                resource.batch = True
+                resource.jobs_path = self.jobs_path
+            resources.append((item['backend'], resource))
+
+        def backend_rows(args):
+            name, resource = args
+            try:
+                if isinstance(resource, Exception):
+                    raise resource
+                result = resource.stats(params.copy())
+            except ResourceFailure as exc:
+                return [dict(exc.result, backend=name)]
+            except Exception as exc:
+                return [{'backend': name, 'failed': True, 'msg': str(exc)}]
+
+            rows = []
+            for pool in self._pools(result['result']):
+                row = {'backend': name,
+                       'pool': pool.get('pool_name', name),
+                       'sampled_at': result['sampled_at']}
+                row.update((field, pool.get(field)) for field in fields)
+                rows.append(row)
+            return rows
+
+        rows = utils.concurrent_map(backend_rows, resources, max_workers)
+        rows = [row for backend in rows for row in backend]
+        return {'changed': False,
+                'failed_count': len([r for r in rows if r.get('failed')]),
+                'result': rows}
+
+
+class Service(Resource):
+    def validate_present(self):
+        specs = self.module.argument_spec.copy()
+        specs.update(socket={'type': 'path', 'required': True},
+                     idle_timeout={'type': 'int',
+                                   'default': service.DEFAULT_IDLE_TIMEOUT})
+        self.module = basic.AnsibleModule(specs, check_invalid_arguments=True)
+
+    def validate_absent(self):
+        specs = self.module.argument_spec.copy()
+        specs.update(socket={'type': 'path', 'required': True})
+        self.module = basic.AnsibleModule(specs, check_invalid_arguments=True)
 
 
 class Volume(Resource):
-    def _validate(self, size_required=False, require_id=False, **kwargs):
+    BATCH_PARAM = 'volumes'
+    BATCH_STATES = ('present', 'absent', 'extended', 'connected',
+                    'disconnected')
+    # Connections need the consumer, so they cannot run in the background
+    BACKGROUND_STATES = ('present', 'absent', 'extended')
+    DEFAULT_LIST_LIMIT = 1000
+    # Set while export tasks hold the locks of their volumes
+    exporting = False
+
+    def _validate(self, size_required=False, require_id=False, fanout=False,
+                  task_specs=None, **kwargs):
+        self.item_specs = dict(name={'type': 'str'},
+                               id={'type': 'str'},
+                               size={'type': 'int', 'required': size_required},
+                               host={'type': 'str', 'default': ''},
+                               **kwargs)
+
+        batch = fanout or self.module.params.get(self.BATCH_PARAM) is not None
         specs = self.module.argument_spec.copy()
-        specs.update(name={'type': 'str'},
-                     id={'type': 'str'},
-                     size={'type': 'int', 'required': size_required},
-                     host={'type': 'str', 'default': ''},
-                     **kwargs)
+        specs.update(self.item_specs)
+        if batch:
+            # Required parameters are checked on each item
+            for key, spec in self.item_specs.items():
+                specs[key] = dict(spec, required=False)
+        specs.update(volumes={'type': 'list'},
+                     max_workers={'type': 'int',
+                                  'default': utils.DEFAULT_MAX_WORKERS},
+                     **(task_specs or {}))
 
         required_one_of = []
-        if require_id:
+        if require_id and not batch:
             required_one_of.append(('name', 'id'))
         self.module = basic.AnsibleModule(specs,
                                           check_invalid_arguments=True,
                                           required_one_of=required_one_of)
 
+    def lock_names(self, state, params):
+        if state not in ('present', 'absent', 'extended', 'connected',
+                         'disconnected'):
+            return []
+        # Locks are named after the addressing parameters instead of looking
+        # up the volume, which the state will do anyway.  Volumes always
+        # belong to a host, and connections lock the volume as well, so they
+        # cannot run concurrently with its deletion.
+        volume = '%s-%s-%s' % (params.get('backend'), params.get('host'),
+                               params.get('name') or params.get('id') or '')
+        # Export tasks already hold the lock of their volumes, so each host
+        # only locks its own connection and they can run concurrently.
+        if state == 'connected' and self.exporting:
+            return ['connection-%s-%s' % (volume, params['attached_host'])]
+        return ['volume-' + volume]
+
     def validate_present(self):
         self._validate(size_required=True)
 
@@ -194,3 +589,160 @@ class Volume(Resource):
         self._validate(attached_host={'type': 'str', 'default': ''},
                        old_size={'type': 'int', 'required': False},
                        size_required=True)
+
+    def validate_list(self):
+        specs = self.module.argument_spec.copy()
+        specs.update(name={'type': 'str'},
+                     id={'type': 'str'},
+                     host={'type': 'str'},
+                     size={'type': 'int'},
+                     min_size={'type': 'int'},
+                     attached_host={'type': 'str'},
+                     limit={'type': 'int', 'default': self.DEFAULT_LIST_LIMIT},
+                     marker={'type': 'str'})
+        self.module = basic.AnsibleModule(specs, check_invalid_arguments=True)
+
+    def _list_volumes(self, params, marker=None, limit=None):
+        """Return an iterable with the volumes that match the filters.
+
+        Volumes must be sorted by id, starting after the marker id.  Only the
+        first limit volumes will be used, all of them if limit is None.
+        """
+        self.fail('Listing volumes is not supported by this provider')
+
+    @Resource.state
+    def list(self, params):
+        """List the volumes that match the filters, a page at a time.
+
+        When there are more volumes than the limit, the next_marker key has the
+        marker to get the next page.
+        """
+        limit = params.pop('limit')
+        marker = params.pop('marker')
+        # One more volume than the limit tells us if there's a next page
+        volumes = self._list_volumes(params, marker, limit and limit + 1)
+        if limit:
+            # Providers can stop fetching volumes once the page is full
+            volumes = itertools.islice(volumes, limit + 1)
+
+        result = {'changed': False, 'volumes': []}
+        for vol in volumes:
+            if limit and len(result['volumes']) == limit:
+                result['next_marker'] = result['volumes'][-1]['id']
+                break
+            result['volumes'].append(self._to_json(vol))
+        return result
+
+    def validate_exported(self):
+        self._validate(fanout=True,
+                       task_specs={'hosts': {'type': 'list',
+                                             'required': True}},
+                       attached_host={'type': 'str', 'required': True},
+                       connector_dict={'type': 'dict', 'required': True})
+
+    @Resource.state
+    def exported(self, params):
+        """Export volumes to a list of hosts.
+
+        Hosts are dictionaries with the host name in the host key and its
+        connector in the connector_dict key.
+        """
+        hosts = params.pop('hosts')
+        items = params.pop(self.BATCH_PARAM) or [{}]
+        max_workers = params.pop('max_workers')
+
+        fanout = []
+        for item in items:
+            for host in hosts:
+                if isinstance(item, dict) and isinstance(host, dict):
+                    fanout.append(dict(
+                        item, attached_host=host.get('host'),
+                        connector_dict=host.get(common.CONNECTOR_DICT)))
+                else:
+                    fanout.append(item)
+
+        volume_locks = set()
+        for item in items:
+            if isinstance(item, dict):
+                item_params = dict(params, **{k: v for k, v in item.items()
+                                              if v is not None})
+                volume_locks.update(self.lock_names('present', item_params))
+
+        with utils.Locks(self.locks_path, volume_locks) as locks:
+            self.timings.add('lock_wait', locks.wait)
+            self.exporting = True
+            try:
+                result = self._execute_batch('connected', params, fanout,
+                                             max_workers)
+            finally:
+                self.exporting = False
+        result['lock_wait'] = round(locks.wait, 3)
+        for item_result in result['results']:
+            if isinstance(item_result['item'], dict):
+                item_result['item'].pop(common.CONNECTOR_DICT, None)
+                item_result.setdefault('attached_host',
+                                       item_result['item']['attached_host'])
+        return result
+
+
+class Job(Resource):
+    """Background jobs started by other resources on this controller."""
+    DEFAULT_STATE = 'status'
+    NEEDS_BACKEND = False
+
+    def _validate(self):
+        specs = self.module.argument_spec.copy()
+        specs.update(id={'type': 'str'},
+                     jobs={'type': 'list'},
+                     timeout={'type': 'int', 'default': jobs.DEFAULT_TIMEOUT})
+        self.module = basic.AnsibleModule(specs,
+                                          check_invalid_arguments=True,
+                                          required_one_of=[('id', 'jobs')])
+
+    validate_status = validate_finished = validate_absent = _validate
+
+    @staticmethod
+    def _job_ids(params):
+        job_ids = list(params.get('jobs') or [])
+        if params.get('id'):
+            job_ids.append(params['id'])
+        # Accept the results of the tasks that started the jobs, skipping
+        # those that didn't start one, like failed or skipped tasks.
+        job_ids = [j.get('job_id') if isinstance(j, dict) else j
+                   for j in job_ids]
+        return [j for j in job_ids if j]
+
+    @staticmethod
+    def _failed(job):
+        if job['state'] == jobs.RUNNING:
+            return False
+        # Lost and missing jobs have failed as well
+        return job['state'] != jobs.FINISHED or job['result'].get('failed')
+
+    def _result(self, job_list):
+        results = [job.get('result') or {} for job in job_list]
+        return {'changed': any(r.get('changed') for r in results),
+                'finished': all(job['state'] != jobs.RUNNING
+                                for job in job_list),
+                'failed_count': len([j for j in job_list if self._failed(j)]),
+                'jobs': job_list}
+
+    @Resource.state
+    def status(self, params):
+        return self._result([jobs.read(self.jobs_path, job_id)
+                             for job_id in self._job_ids(params)])
+
+    @Resource.state
+    def finished(self, params):
+        job_list = jobs.wait(self.jobs_path, self._job_ids(params),
+                             params['timeout'])
+        result = self._result(job_list)
+        if not result['finished']:
+            self.fail('Timed out waiting for jobs', **result)
+        return result
+
+    @Resource.state
+    def absent(self, params):
+        deleted = [jobs.delete(self.jobs_path, job_id)
+                   for job_id in self._job_ids(params)]
+        return {'changed': any(deleted)}
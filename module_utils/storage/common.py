@@ -28,3 +28,5 @@ CONSUMER_CONFIG = 'consumer_config'
 
 CONNECTOR_DICT = 'connector_dict'
 CONNECTION_INFO = 'connection_info'
+
+SERVICE_SOCKET = 'service_socket'
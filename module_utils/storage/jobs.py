@@ -0,0 +1,124 @@
+# Copyright (c) 2018, Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import errno
+import os
+import time
+import uuid
+
+from ansible.module_utils.storage import utils
+
+
+DEFAULT_JOBS_PATH = os.path.join(os.path.expanduser('~'), '.storage_jobs')
+DEFAULT_TIMEOUT = 3600
+MAX_POLL_INTERVAL = 5
+
+RUNNING = 'running'
+FINISHED = 'finished'
+# Job's process died without storing the result
+LOST = 'lost'
+MISSING = 'missing'
+
+
+def _filename(path, job_id):
+    return os.path.join(path, job_id + '.json')
+
+
+def _write(path, job):
+    utils.write_json(_filename(path, job['job_id']), job)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def read(path, job_id):
+    job = utils.read_json(_filename(path, job_id))
+    if job is None:
+        return {'job_id': job_id, 'state': MISSING}
+
+    if (job['state'] == RUNNING and job.get('pid') and
+            not _alive(job['pid'])):
+        job['state'] = LOST
+    return job
+
+
+def start(path, func):
+    """Run func in a detached process and return the job id.
+
+    The func must return the result dictionary that will be stored in the
+    job's file.  Since the module's temporary files are removed once the
+    module exits, everything func needs must already be imported.
+    """
+    utils.makedirs(path)
+
+    job = {'job_id': uuid.uuid4().hex, 'state': RUNNING,
+           'started_at': time.time()}
+    _write(path, job)
+
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return job['job_id']
+
+    # Detach from the module's session so Ansible doesn't wait for us
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+    try:
+        job['pid'] = os.getpid()
+        _write(path, job)
+        try:
+            result = func()
+        except BaseException as exc:
+            result = {'failed': True, 'changed': False, 'msg': str(exc)}
+        job.update(state=FINISHED, finished_at=time.time(), result=result)
+        _write(path, job)
+    finally:
+        os._exit(0)
+
+
+def wait(path, job_ids, timeout=DEFAULT_TIMEOUT):
+    """Wait for jobs to finish, returning their current status."""
+    deadline = time.time() + timeout
+    interval = 0.5
+    while True:
+        jobs = [read(path, job_id) for job_id in job_ids]
+        if (all(job['state'] != RUNNING for job in jobs) or
+                time.time() >= deadline):
+            return jobs
+        time.sleep(min(interval, max(0, deadline - time.time())))
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+
+def delete(path, job_id):
+    try:
+        os.unlink(_filename(path, job_id))
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return False
+    return True
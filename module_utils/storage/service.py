@@ -0,0 +1,211 @@
+# Copyright (c) 2018, Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import errno
+import json
+import os
+import socket
+import time
+
+from ansible.module_utils.six.moves import socketserver
+
+
+DEFAULT_IDLE_TIMEOUT = 3600
+POLL_INTERVAL = 1
+START_TIMEOUT = 30
+
+
+class ServiceError(Exception):
+    pass
+
+
+class Unavailable(ServiceError):
+    pass
+
+
+class Rejected(ServiceError):
+    """Raised by handlers for requests that the caller must run itself."""
+    pass
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def request(path, command, **kwargs):
+    """Send a command to the service listening on path and return reply."""
+    kwargs['command'] = command
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as exc:
+        sock.close()
+        raise Unavailable('Cannot connect to service on %s: %s' % (path, exc))
+
+    try:
+        sock.sendall(json.dumps(kwargs).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        response = _recv_all(sock)
+    finally:
+        sock.close()
+
+    if not response:
+        raise Unavailable('Service on %s closed the connection' % path)
+    return json.loads(response.decode('utf-8'))
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        message = json.loads(_recv_all(self.request).decode('utf-8'))
+        response = self.server.dispatch(message)
+        self.request.sendall(json.dumps(response).encode('utf-8'))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Threaded unix socket server that runs module requests.
+
+    The handler receives the module arguments and must return the result
+    dictionary, just like the module would return it to Ansible.
+
+    Server stops on its own after idle_timeout seconds without requests.
+    """
+    daemon_threads = True
+    timeout = POLL_INTERVAL
+
+    def __init__(self, path, handler, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        # Python 2 SocketServer classes are old style, so no super
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.last_activity = time.time()
+        self.running = True
+
+    def dispatch(self, message):
+        self.last_activity = time.time()
+        command = message.get('command')
+        try:
+            if command == 'run':
+                return self.handler(message['args'])
+            if command == 'stop':
+                self.running = False
+            elif command != 'ping':
+                return {'failed': True,
+                        'msg': 'Unknown service command %s' % command}
+            return {'pid': os.getpid()}
+        finally:
+            self.last_activity = time.time()
+
+    def handle_timeout(self):
+        if time.time() - self.last_activity > self.idle_timeout:
+            self.running = False
+
+    def serve(self):
+        try:
+            while self.running:
+                self.handle_request()
+        finally:
+            self.server_close()
+            _remove(self.path)
+
+
+def _daemonize(path, handler, idle_timeout, write_fd):
+    # Detach from the module's session so Ansible doesn't wait for us
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+
+    try:
+        server = Server(path, handler, idle_timeout)
+    except Exception as exc:
+        os.write(write_fd, ('error: %s' % exc).encode('utf-8'))
+        os._exit(1)
+
+    os.write(write_fd, str(os.getpid()).encode('utf-8'))
+    os.close(write_fd)
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+    try:
+        server.serve()
+    finally:
+        os._exit(0)
+
+
+def running(path):
+    """Return the PID of the service listening on path or None."""
+    try:
+        return request(path, 'ping')['pid']
+    except Unavailable:
+        return None
+
+
+def start(path, handler, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Start a service daemon on path and return its PID.
+
+    Everything the handler needs must already be imported, since the module's
+    temporary files will be removed once the module exits.
+    """
+    # Remove stale socket files left by services that didn't exit cleanly
+    _remove(path)
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        _daemonize(path, handler, idle_timeout, write_fd)
+
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_fd) as f:
+        status = f.read()
+
+    if not status.isdigit():
+        raise ServiceError('Failed to start service on %s: %s' %
+                           (path, status))
+
+    deadline = time.time() + START_TIMEOUT
+    while not running(path):
+        if time.time() > deadline:
+            raise ServiceError('Service on %s is not responding' % path)
+        time.sleep(0.1)
+    return int(status)
+
+
+def stop(path):
+    """Stop the service listening on path, returning its PID or None."""
+    try:
+        return request(path, 'stop')['pid']
+    except Unavailable:
+        _remove(path)
+        return None
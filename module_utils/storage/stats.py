@@ -0,0 +1,64 @@
+# Copyright (c) 2018, Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import hashlib
+import json
+import os
+import time
+
+from ansible.module_utils.storage import utils
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.storage_stats')
+# Background refreshes taking longer than this are considered dead
+REFRESH_TIMEOUT = 600
+
+
+def cache_key(storage_data):
+    """Return the cache key of a backend.
+
+    Changes to the backend's configuration invalidate its cached stats.
+    """
+    data = json.dumps(storage_data, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _filename(path, key):
+    return os.path.join(path, key + '.json')
+
+
+def read(path, key):
+    """Return the cached stats entry or None if there isn't one."""
+    return utils.read_json(_filename(path, key))
+
+
+def write(path, key, stats):
+    utils.makedirs(path)
+    entry = {'stats': stats, 'sampled_at': time.time()}
+    utils.write_json(_filename(path, key), entry)
+    return entry
+
+
+def refreshing(entry):
+    started = entry.get('refresh_started_at')
+    return bool(started) and time.time() - started < REFRESH_TIMEOUT
+
+
+def mark_refresh(path, key, entry):
+    """Flag the entry so other requests don't start another refresh."""
+    entry = dict(entry, refresh_started_at=time.time())
+    utils.write_json(_filename(path, key), entry)
+    return entry
@@ -0,0 +1,179 @@
+# Copyright (c) 2018, Red Hat, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from ansible.module_utils.six.moves import queue
+
+
+try:
+    clock = time.monotonic
+except AttributeError:
+    clock = time.time
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_LOCKS_PATH = os.path.join(os.path.expanduser('~'), '.storage_locks')
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def write_json(filename, data):
+    """Write and rename so readers never see partial files.
+
+    Temporary files are unique, so threads and processes can write the same
+    file concurrently, and the last rename wins.
+    """
+    path, name = os.path.split(filename)
+    fd, tmp_filename = tempfile.mkstemp(dir=path or '.', prefix=name)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_filename, filename)
+    except Exception:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
+def read_json(filename):
+    """Return the contents of a JSON file or None if it cannot be read."""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def concurrent_map(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """Call func for each item using at most max_workers threads.
+
+    Results are returned in the same order as the items.  Exceptions are not
+    handled, so func should catch its own if we want the rest of the items to
+    be processed.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    max_workers = max(1, min(max_workers or 1, len(items)))
+
+    if max_workers == 1:
+        return [func(item) for item in items]
+
+    pending = queue.Queue()
+    for i, item in enumerate(items):
+        pending.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = pending.get_nowait()
+            except queue.Empty:
+                return
+            results[i] = func(item)
+
+    threads = [threading.Thread(target=worker) for __ in range(max_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class Locks(object):
+    """Inter process file locks on a set of resource names.
+
+    Locks are acquired in a consistent order to prevent deadlocks, and the
+    time spent waiting for them is available in the wait attribute.
+    """
+    INVALID_CHARS = re.compile(r'[^\w.@-]')
+
+    def __init__(self, path, names):
+        self.path = path
+        self.names = sorted(set(names))
+        self.wait = 0.0
+        self._files = []
+
+    def _filename(self, name):
+        return os.path.join(self.path,
+                            'storage-' + self.INVALID_CHARS.sub('_', name))
+
+    def __enter__(self):
+        makedirs(self.path)
+        start = time.time()
+        try:
+            for name in self.names:
+                f = open(self._filename(name), 'a')
+                self._files.append(f)
+                fcntl.flock(f, fcntl.LOCK_EX)
+        except Exception:
+            self._release()
+            raise
+        self.wait = time.time() - start
+        return self
+
+    def _release(self):
+        while self._files:
+            f = self._files.pop()
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._release()
+
+
+class Timings(object):
+    """Accumulated duration, in seconds, of the phases of a request.
+
+    Phases with the same name add up, which is what we want when they run for
+    each of the items of a batch request.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        if self.enabled:
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add(name, clock() - start)
+
+    def result(self):
+        return {name: round(duration, 6)
+                for name, duration in self.phases.items()}